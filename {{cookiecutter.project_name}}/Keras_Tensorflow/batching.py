@@ -0,0 +1,453 @@
+"""Request-coalescing scheduler for the model driver.
+
+Concurrent calls to the scoring endpoint each carry only a handful of images, so
+scoring them one request at a time runs the model with very small batches. The
+MicroBatcher queues the images of concurrent requests and hands them to the
+scoring function as a single batch once either the maximum batch size or the
+maximum wait time is reached. The results are then split and returned to each
+caller in the order their images were submitted.
+
+The queue is bounded: once it holds too many images, or the estimated time to
+score them is too long, new requests are rejected straight away with a
+QueueFullError that suggests when to retry. Requests whose deadline passes
+while they are queued are dropped before they are scored.
+
+Run this module directly to benchmark batched against unbatched scoring on a
+randomly initialised ResNet152:
+
+    python batching.py --clients 8 --requests 16 --max-batch-size 8 --max-wait-ms 5
+
+or to overload a batcher with a slow scoring function, with and without
+admission control:
+
+    python batching.py --overload --clients 64 --requests 20
+
+"""
+import logging
+import math
+import threading
+import timeit as t
+from collections import Counter
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+
+class QueueFullError(Exception):
+    """ Raised by MicroBatcher.submit when a request is not admitted
+
+    retry_after is a suggestion in whole seconds of when to try again
+    """
+
+    def __init__(self, message, retry_after):
+        super(QueueFullError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """ Set on the Future of a request whose deadline passed before it was scored
+    """
+
+
+class _PendingRequest(object):
+    def __init__(self, items, deadline=None):
+        self.items = items
+        self.future = Future()
+        self.enqueued = t.default_timer()
+        self.deadline = deadline
+
+
+class BatchStatistics(object):
+    """ Thread safe counters for the batches flushed by a MicroBatcher
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._batch_sizes = Counter()
+            self._num_batches = 0
+            self._num_items = 0
+            self._num_requests = 0
+            self._total_wait = 0.0
+            self._max_wait = 0.0
+            self._num_shed = 0
+            self._num_expired = 0
+
+    def record(self, batch_size, queue_waits):
+        with self._lock:
+            self._batch_sizes[batch_size] += 1
+            self._num_batches += 1
+            self._num_items += batch_size
+            self._num_requests += len(queue_waits)
+            self._total_wait += sum(queue_waits)
+            self._max_wait = max([self._max_wait] + list(queue_waits))
+
+    def record_shed(self):
+        with self._lock:
+            self._num_shed += 1
+
+    def record_expired(self, num_requests):
+        with self._lock:
+            self._num_expired += num_requests
+
+    def snapshot(self):
+        """ Return the statistics as a JSON serializable dict, times are in ms
+        """
+        with self._lock:
+            num_batches = max(self._num_batches, 1)
+            num_requests = max(self._num_requests, 1)
+            return {
+                "batches": self._num_batches,
+                "images": self._num_items,
+                "requests": self._num_requests,
+                "mean_batch_size": round(self._num_items / num_batches, 2),
+                "batch_size_histogram": {
+                    str(size): count for size, count in sorted(self._batch_sizes.items())
+                },
+                "mean_queue_wait_ms": round(self._total_wait * 1000 / num_requests, 3),
+                "max_queue_wait_ms": round(self._max_wait * 1000, 3),
+                "shed_requests": self._num_shed,
+                "expired_requests": self._num_expired,
+            }
+
+
+class MicroBatcher(object):
+    """ Coalesces the images of concurrent requests into batches for batch_func
+
+    Keyword arguments:
+    batch_func -- function that takes a list of images and returns a list with
+        one result per image, e.g. the call_model function of the driver
+    max_batch_size -- maximum number of images sent to batch_func at once.
+        The images of a single request are never split, so a request larger
+        than max_batch_size is scored as a batch of its own. (default 8)
+    max_wait_ms -- maximum time in milliseconds the first request of a batch
+        waits for other requests to join it. (default 5)
+    observe -- optional function called with "queue_wait" and the seconds each
+        request waited in the queue before its batch was dispatched. (default None)
+    max_queue_images -- requests are rejected while this many images are queued,
+        None for no limit. (default None)
+    max_queue_wait_ms -- requests are rejected while the queued images are
+        estimated to take longer than this to score, None for no limit.
+        The estimate is based on the recent time per image of batch_func.
+        (default None)
+
+    """
+
+    def __init__(
+        self,
+        batch_func,
+        max_batch_size=8,
+        max_wait_ms=5,
+        observe=None,
+        max_queue_images=None,
+        max_queue_wait_ms=None,
+    ):
+        self._batch_func = batch_func
+        self.observe = observe
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_images = max_queue_images
+        self.max_queue_wait = None if max_queue_wait_ms is None else max_queue_wait_ms / 1000.0
+        self.statistics = BatchStatistics()
+        self._queue = Queue()
+        self._queue_lock = threading.Lock()
+        self._queued_images = 0
+        self._seconds_per_image = 0.0
+        self._carry_over = None
+        self._logger = logging.getLogger("model_driver")
+        self._worker = threading.Thread(target=self._run, name="micro-batcher")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def estimated_wait(self, num_images=0):
+        """ Estimated seconds to score the queued images and num_images more
+        """
+        with self._queue_lock:
+            return (self._queued_images + num_images) * self._seconds_per_image
+
+    def _admit(self, num_images):
+        """ Count the images of a request as queued or raise QueueFullError
+        """
+        with self._queue_lock:
+            queued = self._queued_images + num_images
+            wait = queued * self._seconds_per_image
+            # A single request is always admitted into an empty queue
+            if self._queued_images and (
+                (self.max_queue_images is not None and queued > self.max_queue_images)
+                or (self.max_queue_wait is not None and wait > self.max_queue_wait)
+            ):
+                self.statistics.record_shed()
+                raise QueueFullError(
+                    "{} images queued, estimated wait {:.0f} ms".format(
+                        self._queued_images, wait * 1000
+                    ),
+                    retry_after=max(1, int(math.ceil(wait))),
+                )
+            self._queued_images = queued
+
+    def submit(self, items, deadline=None):
+        """ Queue a list of images and return a Future for their results
+
+        deadline is an optional timeit.default_timer() value after which the
+        images are not scored any more and DeadlineExceededError is set instead.
+        Raises QueueFullError if the request is not admitted.
+        """
+        request = _PendingRequest(list(items), deadline)
+        if not request.items:
+            request.future.set_result([])
+        else:
+            self._admit(len(request.items))
+            self._queue.put(request)
+        return request.future
+
+    def __call__(self, items, deadline=None):
+        return self.submit(items, deadline).result()
+
+    def _next_batch(self):
+        first = self._carry_over or self._queue.get()
+        self._carry_over = None
+        batch = [first]
+        batch_size = len(first.items)
+        deadline = first.enqueued + self.max_wait
+        while batch_size < self.max_batch_size:
+            # Requests that are already queued always join the batch, only
+            # waiting for new ones is bounded by the deadline
+            remaining = deadline - t.default_timer()
+            try:
+                if remaining > 0:
+                    request = self._queue.get(timeout=remaining)
+                else:
+                    request = self._queue.get_nowait()
+            except Empty:
+                break
+            if batch_size + len(request.items) > self.max_batch_size:
+                self._carry_over = request
+                break
+            batch.append(request)
+            batch_size += len(request.items)
+        with self._queue_lock:
+            self._queued_images -= batch_size
+        return batch, batch_size
+
+    def _drop_expired(self, batch):
+        """ Fail the requests whose deadline has passed and return the others
+        """
+        now = t.default_timer()
+        expired = [
+            request
+            for request in batch
+            if request.deadline is not None and request.deadline < now
+        ]
+        if not expired:
+            return batch
+        for request in expired:
+            request.future.set_exception(
+                DeadlineExceededError(
+                    "Deadline passed {:.0f} ms before scoring".format(
+                        (now - request.deadline) * 1000
+                    )
+                )
+            )
+        self.statistics.record_expired(len(expired))
+        return [request for request in batch if request not in expired]
+
+    def _run(self):
+        while True:
+            batch, _ = self._next_batch()
+            try:
+                self._score(batch)
+            except Exception as error:
+                # An exception here would otherwise end this thread and leave
+                # every queued request waiting forever
+                self._logger.exception("Scoring a batch failed")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+
+    def _score(self, batch):
+        batch = self._drop_expired(batch)
+        if not batch:
+            return
+        batch_size = sum(len(request.items) for request in batch)
+        dispatched = t.default_timer()
+        queue_waits = [dispatched - request.enqueued for request in batch]
+        self.statistics.record(batch_size, queue_waits)
+        if self.observe is not None:
+            for wait in queue_waits:
+                self.observe("queue_wait", wait)
+        self._logger.debug(
+            "Scoring batch of {} images from {} requests".format(
+                batch_size, len(batch)
+            )
+        )
+        try:
+            results = self._batch_func(
+                [item for request in batch for item in request.items]
+            )
+            seconds_per_image = (t.default_timer() - dispatched) / batch_size
+            with self._queue_lock:
+                # Moving average that follows changes in load and batch size
+                if self._seconds_per_image:
+                    self._seconds_per_image += 0.2 * (
+                        seconds_per_image - self._seconds_per_image
+                    )
+                else:
+                    self._seconds_per_image = seconds_per_image
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].future.set_exception(error)
+            else:
+                # Score the requests one by one so that a single bad
+                # image only fails the request it came with
+                self._run_separately(batch)
+            return
+        offset = 0
+        for request in batch:
+            request.future.set_result(
+                list(results[offset : offset + len(request.items)])
+            )
+            offset += len(request.items)
+
+    def _run_separately(self, batch):
+        for request in batch:
+            try:
+                request.future.set_result(list(self._batch_func(request.items)))
+            except Exception as error:
+                request.future.set_exception(error)
+
+
+def _benchmark(clients, requests_per_client, max_batch_size, max_wait_ms):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+    from keras.applications.imagenet_utils import preprocess_input
+    from resnet152 import ResNet152
+
+    model = ResNet152(weights=None)
+
+    def call_model(img_array_list):
+        img_array = preprocess_input(np.stack(img_array_list))
+        return list(np.argmax(model.predict(img_array), axis=1))
+
+    img = np.random.randint(0, 255, size=(224, 224, 3)).astype(np.float32)
+    call_model([img])  # Warm up
+
+    def run_clients(scoring_func):
+        def client(_):
+            for _ in range(requests_per_client):
+                scoring_func([img.copy()])
+
+        start = t.default_timer()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(client, range(clients)))
+        return t.default_timer() - start
+
+    total = clients * requests_per_client
+    unbatched = run_clients(call_model)
+    print(
+        "Unbatched: {0} requests in {1:.2f} s ({2:.2f} images/s)".format(
+            total, unbatched, total / unbatched
+        )
+    )
+    batcher = MicroBatcher(
+        call_model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+    )
+    batched = run_clients(batcher)
+    print(
+        "Batched:   {0} requests in {1:.2f} s ({2:.2f} images/s)".format(
+            total, batched, total / batched
+        )
+    )
+    print("Batch statistics:", batcher.statistics.snapshot())
+
+
+def _overload_benchmark(clients, requests_per_client, max_batch_size, deadline_ms, image_ms):
+    """ Compare an unbounded queue with admission control under overload
+
+    The scoring function sleeps image_ms per image, so no model is needed.
+    Every client sends its requests back to back with a deadline of
+    deadline_ms, which is more than the batcher can keep up with.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import time
+
+    import numpy as np
+
+    def sleeping_batch_func(items):
+        time.sleep(image_ms * len(items) / 1000.0)
+        return items
+
+    def run(batcher):
+        outcomes = Counter()
+        latencies = []
+        lock = threading.Lock()
+
+        def client(_):
+            for _ in range(requests_per_client):
+                start = t.default_timer()
+                try:
+                    batcher([0], deadline=start + deadline_ms / 1000.0)
+                    outcome = "accepted"
+                except QueueFullError:
+                    outcome = "shed"
+                    # Back off as a client honouring Retry-After would
+                    time.sleep(deadline_ms / 1000.0)
+                except DeadlineExceededError:
+                    outcome = "expired"
+                latency = (t.default_timer() - start) * 1000
+                with lock:
+                    outcomes[outcome] += 1
+                    if outcome == "accepted":
+                        latencies.append(latency)
+
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(client, range(clients)))
+        return outcomes, latencies
+
+    runs = (
+        ("unbounded", {}),
+        (
+            "admission control",
+            {"max_queue_images": 4 * max_batch_size, "max_queue_wait_ms": deadline_ms / 2},
+        ),
+    )
+    for name, limits in runs:
+        batcher = MicroBatcher(sleeping_batch_func, max_batch_size, max_wait_ms=5, **limits)
+        outcomes, latencies = run(batcher)
+        print(
+            "{0:<18} accepted {1:5d}  shed {2:5d}  expired {3:5d}  "
+            "accepted latency p50 {4:8.1f} ms  p99 {5:8.1f} ms".format(
+                name,
+                outcomes["accepted"],
+                outcomes["shed"],
+                outcomes["expired"],
+                float(np.percentile(latencies, 50)) if latencies else float("nan"),
+                float(np.percentile(latencies, 99)) if latencies else float("nan"),
+            )
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--overload", action="store_true",
+                        help="overload a batcher with a slow fake scoring function instead")
+    parser.add_argument("--deadline-ms", type=float, default=500,
+                        help="client deadline of the overload benchmark")
+    parser.add_argument("--image-ms", type=float, default=10,
+                        help="time the fake scoring function of the overload benchmark takes per image")
+    args = parser.parse_args()
+    if args.overload:
+        _overload_benchmark(
+            args.clients, args.requests, args.max_batch_size, args.deadline_ms, args.image_ms
+        )
+    else:
+        _benchmark(args.clients, args.requests, args.max_batch_size, args.max_wait_ms)
@@ -0,0 +1,436 @@
+"""Offline end-to-end latency and throughput benchmark of the model driver.
+
+The benchmark needs neither a workspace nor a deployed service. It serves the
+driver's init() and run() from a local HTTP server, with a randomly
+initialised ResNet152 instead of the registered weights, and posts
+variations of a local image to it from a number of concurrent clients. For
+every maximum batch size and concurrency it records the latency percentiles,
+the throughput and the batch statistics reported by the driver, and it times
+the preprocessing, model.predict and top-k stages separately at
+each batch size. The results are written as JSON so that runs can be compared
+to catch performance regressions before an image is built.
+
+    python benchmark.py --batch-sizes 1,8 --concurrency 1,4,8 --requests 20 --output benchmark_results.json
+
+With --ingestion it only measures the server CPU time per request spent on
+parsing the upload and turning it into model input, for JPEG uploads of a few
+sizes and for raw tensor uploads that need no decoding:
+
+    python benchmark.py --ingestion --jpeg-sizes 224,640,1920
+
+With --imports it measures the wall time and memory of importing
+testing_utilities, preprocessing and the driver in fresh interpreters. It
+exits with an error if testing_utilities loads asyncio, matplotlib or the
+azureml authentication, if any of them loads keras or TensorFlow, or if one
+takes longer than --max-import-ms:
+
+    python benchmark.py --imports --max-import-ms 1000
+
+driver.py is written from 02_DevelopModelDriver.ipynb if it does not exist or is
+older than the notebook.
+
+"""
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import timeit as t
+from datetime import datetime
+from io import BytesIO
+from itertools import cycle
+
+import numpy as np
+import requests
+from PIL import Image
+
+from testing_utilities import gen_variations_of_one_image
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_DRIVER_NOTEBOOK = os.path.join(_HERE, "02_DevelopModelDriver.ipynb")
+_LOCAL_IMAGE = os.path.join(_HERE, "220px-Lynx_lynx_poing.jpg")
+
+
+def ensure_driver():
+    """ Write driver.py from the driver notebook if it is missing or older than the notebook
+    """
+    driver_path = os.path.join(_HERE, "driver.py")
+    # An older driver.py would not have the changes made to the driver cell since
+    if not os.path.exists(driver_path) or os.path.getmtime(driver_path) < os.path.getmtime(
+        _DRIVER_NOTEBOOK
+    ):
+        with open(_DRIVER_NOTEBOOK) as f:
+            cells = json.load(f)["cells"]
+        for cell in cells:
+            source = "".join(cell["source"])
+            if source.startswith("%%writefile driver.py"):
+                with open(driver_path, "w") as f:
+                    f.write(source.split("\n", 1)[1])
+                break
+    if _HERE not in sys.path:
+        sys.path.insert(0, _HERE)
+    return driver_path
+
+
+def local_image(tmp_dir):
+    """ Path of the Lynx image downloaded by 01_DevelopModel.ipynb or of a generated one
+    """
+    if os.path.exists(_LOCAL_IMAGE):
+        return _LOCAL_IMAGE
+    path = os.path.join(tmp_dir, "benchmark_image.jpg")
+    gradient = np.linspace(0, 255, 220, dtype=np.float32)
+    pixels = np.stack(
+        [np.add.outer(gradient, gradient) / 2, np.outer(gradient, gradient) / 255,
+         np.add.outer(gradient[::-1], gradient) / 2],
+        axis=-1,
+    )
+    Image.fromarray(pixels.astype(np.uint8)).save(path, "JPEG")
+    return path
+
+
+def _offline_class_index():
+    """ Avoid downloading the imagenet class index when it is not cached
+    """
+    from keras.applications import imagenet_utils
+
+    cached = os.path.join(os.path.expanduser("~"), ".keras", "models", "imagenet_class_index.json")
+    if imagenet_utils.CLASS_INDEX is None and not os.path.exists(cached):
+        imagenet_utils.CLASS_INDEX = {
+            str(i): ["n{:08d}".format(i), "class_{}".format(i)] for i in range(1000)
+        }
+
+
+def save_random_weights(tmp_dir):
+    from resnet152 import ResNet152
+    import keras.backend as K
+
+    model_path = os.path.join(tmp_dir, "model_resnet_weights.h5")
+    ResNet152(weights=None).save_weights(model_path)
+    K.clear_session()
+    return model_path
+
+
+class LocalService(object):
+    """ Serves a freshly imported driver with a local werkzeug server
+
+    Keyword arguments:
+    model_path -- weights or model artifact the driver loads
+    env -- environment variables that configure the driver, e.g. MAX_BATCH_SIZE
+
+    """
+
+    def __init__(self, model_path, env=None):
+        self._env = dict(env or {}, MODEL_PATH=model_path)
+        self._server = None
+        self.driver = None
+
+    def __enter__(self):
+        from werkzeug.serving import make_server
+        from werkzeug.wrappers import Request, Response
+
+        os.environ.update(self._env)
+        ensure_driver()
+        _offline_class_index()
+        if "driver" in sys.modules:
+            self.driver = importlib.reload(sys.modules["driver"])
+        else:
+            self.driver = importlib.import_module("driver")
+        self.driver.init()
+
+        @Request.application
+        def application(request):
+            result = self.driver.run(request)
+            if isinstance(result, Response):
+                return result
+            return Response(json.dumps(result), mimetype="application/json")
+
+        self._server = make_server("127.0.0.1", 0, application, threaded=True)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/score".format(self._server.server_port)
+
+    def __exit__(self, *exc_info):
+        import keras.backend as K
+
+        self._server.shutdown()
+        for key in self._env:
+            os.environ.pop(key, None)
+        K.clear_session()
+
+
+def run_clients(url, images, concurrency, requests_per_client):
+    """ Post images from concurrent clients and return latencies in s and wall time
+    """
+    latencies = [[] for _ in range(concurrency)]
+
+    def client(index):
+        session = requests.Session()
+        image_iter = cycle(images[index::concurrency] or images)
+        for _ in range(requests_per_client):
+            start = t.default_timer()
+            resp = session.post(url, files={"image": next(image_iter)})
+            resp.raise_for_status()
+            latencies[index].append(t.default_timer() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = t.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [lat for client_lat in latencies for lat in client_lat], t.default_timer() - start
+
+
+def latency_summary(latencies):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mean": round(float(np.mean(latencies_ms)), 2),
+        "p50": round(float(np.percentile(latencies_ms, 50)), 2),
+        "p95": round(float(np.percentile(latencies_ms, 95)), 2),
+        "p99": round(float(np.percentile(latencies_ms, 99)), 2),
+        "max": round(float(np.max(latencies_ms)), 2),
+    }
+
+
+def stage_timings(images, batch_sizes, repeats=3):
+    """ Best time in ms of each scoring stage at each batch size
+    """
+    import keras.backend as K
+    from preprocessing import BatchPreprocessor
+    from resnet152 import ResNet152, fuse_for_inference
+    from response_format import top_k_lists
+
+    model = fuse_for_inference(ResNet152(weights=None))
+    preprocess = BatchPreprocessor()
+    timings = {}
+    for batch_size in batch_sizes:
+        refs = [BytesIO(images[i % len(images)]) for i in range(batch_size)]
+
+        def best(func):
+            times = []
+            for _ in range(repeats):
+                for ref in refs:
+                    ref.seek(0)
+                start = t.default_timer()
+                result = func()
+                times.append(t.default_timer() - start)
+            return result, round(min(times) * 1000, 2)
+
+        img_array, preprocess_ms = best(lambda: preprocess(refs))
+        model.predict(img_array)  # Warm up this batch size
+        preds, predict_ms = best(lambda: model.predict(img_array))
+        _, top_k_ms = best(lambda: top_k_lists(preds, 3))
+        timings[str(batch_size)] = {
+            "preprocess_ms": preprocess_ms,
+            "predict_ms": predict_ms,
+            "top_k_ms": top_k_ms,
+        }
+    K.clear_session()
+    return timings
+
+
+# Heavy packages that importing each module must not load, they are imported
+# where they are needed
+_LAZY_IMPORTS = (
+    (
+        "testing_utilities",
+        ("asyncio", "matplotlib", "azureml", "keras", "tensorflow", "preprocessing"),
+    ),
+    ("preprocessing", ("keras", "tensorflow")),
+    ("driver", ("keras", "tensorflow", "resnet152")),
+)
+
+# The peak RSS of getrusage starts at that of the parent process, so the
+# current RSS is read from /proc, which is Linux only
+_IMPORT_PROBE = """
+import json, sys, time
+def rss_kb():
+    with open("/proc/self/status") as f:
+        return int([line for line in f if line.startswith("VmRSS:")][0].split()[1])
+sys.path.insert(0, {directory!r})
+rss = rss_kb()
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "rss_kb": rss_kb() - rss,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+
+def import_costs(lazy_imports=_LAZY_IMPORTS, repeats=5):
+    """ Wall time and resident memory of importing each module in a fresh interpreter
+
+    Returns a dict of module names to the best import time in ms, the growth
+    of the RSS in MB and the packages it should not have loaded but did.
+    """
+    import subprocess
+
+    ensure_driver()
+    results = {}
+    for module, lazy in lazy_imports:
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.check_output(
+                [sys.executable, "-c", _IMPORT_PROBE.format(directory=_HERE, module=module)]
+            )
+            runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+        loaded = set(name.split(".")[0] for name in runs[0]["modules"])
+        results[module] = {
+            "import_ms": round(min(run["seconds"] for run in runs) * 1000, 1),
+            "rss_mb": round(min(run["rss_kb"] for run in runs) / 1024, 1),
+            "eager_imports": sorted(loaded.intersection(lazy)),
+        }
+        print(
+            "{0:<18} {1:8.1f} ms  {2:7.1f} MB  {3}".format(
+                module,
+                results[module]["import_ms"],
+                results[module]["rss_mb"],
+                "loads " + ", ".join(results[module]["eager_imports"])
+                if results[module]["eager_imports"] else "",
+            )
+        )
+    return results
+
+
+def ingestion_cpu(image_path, sizes, repeats=200):
+    """ Server CPU ms per single image request, from the multipart body to the model input
+
+    Compares multipart uploads of the image as a JPEG, resized so that its
+    longer side is each of sizes, with the raw tensor of to_tensor posted as a
+    multipart upload and as the request body. Every request is parsed by
+    werkzeug and turned into a normalised batch as the driver does.
+    """
+    import time
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.wrappers import Request
+    from preprocessing import BatchPreprocessor, image_ref_from_upload, request_uploads
+    from testing_utilities import _encode_multipart, to_bytes, to_tensor
+
+    preprocess = BatchPreprocessor()
+    source = Image.open(image_path).convert("RGB")
+    cases = []
+    for size in sizes:
+        scale = size / max(source.size)
+        img = source.resize((round(source.width * scale), round(source.height * scale)), Image.BICUBIC)
+        body, content_type = _encode_multipart({"image": to_bytes(img)})
+        cases.append(("JPEG {}x{}".format(*img.size), body, content_type))
+    tensor = to_tensor("file://" + os.path.abspath(image_path))
+    body, content_type = _encode_multipart({"image": tensor})
+    cases.append(("multipart tensor", body, content_type))
+    cases.append(("tensor body", tensor[0], tensor[1]))
+
+    results = {}
+    for name, body, content_type in cases:
+
+        def handle():
+            environ = EnvironBuilder(
+                method="POST", input_stream=BytesIO(body), content_type=content_type,
+                content_length=len(body),
+            ).get_environ()
+            uploads = request_uploads(Request(environ))
+            preprocess([image_ref_from_upload(upload) for upload in uploads.values()])
+
+        handle()
+        start = time.process_time()
+        for _ in range(repeats):
+            handle()
+        cpu_ms = (time.process_time() - start) * 1000 / repeats
+        results[name] = {"upload_bytes": len(body), "cpu_ms": round(cpu_ms, 3)}
+        print("{0:<18} {1:9d} bytes  {2:8.3f} ms CPU per request".format(name, len(body), cpu_ms))
+    return results
+
+
+def run_benchmark(batch_sizes, concurrencies, requests_per_client, num_variations, output):
+    import keras
+    import tensorflow
+
+    tmp_dir = tempfile.mkdtemp()
+    image_path = local_image(tmp_dir)
+    images = gen_variations_of_one_image("file://" + image_path, num_variations)
+    model_path = save_random_weights(tmp_dir)
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "keras": keras.__version__,
+        "tensorflow": tensorflow.__version__,
+        "image": os.path.basename(image_path),
+        "requests_per_client": requests_per_client,
+        "runs": [],
+    }
+    for batch_size in batch_sizes:
+        # The prediction cache would answer the repeated variations
+        env = {"MAX_BATCH_SIZE": str(batch_size), "PREDICTION_CACHE_ENTRIES": "0"}
+        with LocalService(model_path, env) as service:
+            for concurrency in concurrencies:
+                service.driver.process_and_score.batch_statistics.reset()
+                latencies, wall_time = run_clients(
+                    service.url, images, concurrency, requests_per_client
+                )
+                run = {
+                    "max_batch_size": batch_size,
+                    "concurrency": concurrency,
+                    "requests": len(latencies),
+                    "throughput_rps": round(len(latencies) / wall_time, 2),
+                    "latency_ms": latency_summary(latencies),
+                    "batching": service.driver.process_and_score.batch_statistics.snapshot(),
+                }
+                print(
+                    "max batch {max_batch_size:>3} concurrency {concurrency:>3}: "
+                    "{throughput_rps:8.2f} req/s  p50 {p50:8.2f} ms  p99 {p99:8.2f} ms".format(
+                        p50=run["latency_ms"]["p50"], p99=run["latency_ms"]["p99"], **run
+                    )
+                )
+                results["runs"].append(run)
+    results["stages"] = stage_timings(images, sorted(set(batch_sizes) | {1}))
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print("Results written to", output)
+    return results
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 8],
+                        help="comma separated MAX_BATCH_SIZE values")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 8],
+                        help="comma separated numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--variations", type=int, default=100)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--ingestion", action="store_true",
+                        help="only compare the server CPU per request of JPEG and raw tensor uploads")
+    parser.add_argument("--jpeg-sizes", type=_int_list, default=[224, 640, 1920],
+                        help="comma separated longer sides of the JPEG uploads")
+    parser.add_argument("--imports", action="store_true",
+                        help="only measure the import time and memory of the modules, and fail if "
+                             "they load packages that should be imported lazily or exceed --max-import-ms")
+    parser.add_argument("--max-import-ms", type=float, help="import time budget of every module")
+    args = parser.parse_args()
+    if args.imports:
+        costs = import_costs()
+        sys.exit(
+            any(
+                cost["eager_imports"] or (args.max_import_ms and cost["import_ms"] > args.max_import_ms)
+                for cost in costs.values()
+            )
+        )
+    if args.ingestion:
+        ingestion_cpu(local_image(tempfile.mkdtemp()), args.jpeg_sizes)
+        sys.exit()
+    run_benchmark(args.batch_sizes, args.concurrency, args.requests, args.variations, args.output)
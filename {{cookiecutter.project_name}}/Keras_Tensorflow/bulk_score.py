@@ -0,0 +1,446 @@
+"""Offline bulk scoring of stored images with the driver's scoring code.
+
+Backfills score far more images than are worth sending to the web service one
+request at a time. score_images reads the images of a directory tree or of a
+tar archive, compressed or not, in a fixed order and scores them with the
+model loading, preprocessing and top-k post-processing of the driver, so the
+predictions are the ones run() returns:
+
+- a reader thread reads the images ahead of the model,
+- a pool of decode workers decodes and normalises whole batches while the
+  model predicts the previous ones,
+- the model gets batches of a fixed size, only the last one may be smaller,
+- the predictions are written as JSON lines, or as a directory of Parquet
+  parts (needs pyarrow), and every checkpoint_every images a checkpoint is
+  written next to the output. A run that is interrupted resumes after the
+  last checkpoint when it is started again.
+
+Images that cannot be decoded get an error instead of predictions.
+
+    python bulk_score.py images/ predictions.jsonl --model model_resnet152.bin --batch-size 32
+    python bulk_score.py images.tar.gz predictions.parquet --random-weights
+
+driver.py is written from 02_DevelopModelDriver.ipynb if it does not exist or is
+older than the notebook.
+
+"""
+import json
+import logging
+import os
+import queue
+import tarfile
+import tempfile
+import threading
+import timeit as t
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from itertools import islice
+
+import numpy as np
+
+from preprocessing import BatchPreprocessor
+from response_format import to_json, top_k_lists
+
+_EXTENSIONS = (".jpg", ".jpeg", ".png")
+_DONE = object()
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _read_member(archive, member):
+    return archive.extractfile(member).read()
+
+
+def _directory_entries(directory):
+    for root, subdirectories, names in os.walk(directory):
+        subdirectories.sort()
+        for name in sorted(names):
+            if name.lower().endswith(_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, directory), partial(_read_file, path)
+
+
+def _archive_entries(path):
+    # Stream mode reads the archive sequentially, also when it is compressed
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith(_EXTENSIONS):
+                yield member.name, partial(_read_member, archive, member)
+
+
+def iter_images(source, skip=0):
+    """ (key, bytes) of the images of a directory tree or tar archive, in a fixed order
+
+    Keys are paths relative to the directory or names of archive members. The
+    first skip images are passed over without being read.
+    """
+    entries = _directory_entries(source) if os.path.isdir(source) else _archive_entries(source)
+    for key, read in islice(entries, skip, None):
+        # Members of an archive have to be read before moving on to the next one
+        yield key, read()
+
+
+class _JsonLinesWriter(object):
+    """ Writes one JSON object per image, its state is the number of bytes written
+    """
+
+    def __init__(self, path, state=None):
+        if not os.path.exists(path) and state:
+            raise ValueError(
+                "{} is missing but its checkpoint counts {} bytes, pass restart=True to score "
+                "from the start".format(path, state)
+            )
+        if state is None or not os.path.exists(path):
+            self._file = open(path, "wb")
+        else:
+            # Drop whatever was written after the checkpoint
+            self._file = open(path, "r+b")
+            self._file.truncate(state)
+            self._file.seek(state)
+
+    def write(self, records):
+        self._file.write("".join(json.dumps(record) + "\n" for record in records).encode("utf-8"))
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter(object):
+    """ Writes the images of every checkpoint to a part file of a directory
+
+    Its state is the number of part files written.
+    """
+
+    def __init__(self, directory, state=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow, pip install pyarrow")
+        self._pyarrow = pyarrow
+        # Every part has the same schema, even if its errors or predictions are
+        # all missing, so that the directory can be read as one dataset
+        self._schema = pyarrow.schema(
+            [
+                ("key", pyarrow.string()),
+                ("error", pyarrow.string()),
+                ("wordnet_ids", pyarrow.list_(pyarrow.string())),
+                ("names", pyarrow.list_(pyarrow.string())),
+                ("scores", pyarrow.list_(pyarrow.float32())),
+            ]
+        )
+        self._directory = directory
+        self._parts = state or 0
+        self._records = []
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            # Drop the parts written after the checkpoint and the temporary
+            # files of parts that were being written when the run was stopped
+            if (name.startswith("part-") and int(name[5:10]) >= self._parts) or name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+
+    def write(self, records):
+        self._records.extend(records)
+
+    def checkpoint(self):
+        if self._records:
+            predictions = [record.get("predictions", []) for record in self._records]
+            table = self._pyarrow.Table.from_pydict(
+                {
+                    "key": [record["key"] for record in self._records],
+                    "error": [record.get("error") for record in self._records],
+                    "wordnet_ids": [[pred[0] for pred in preds] for preds in predictions],
+                    "names": [[pred[1] for pred in preds] for preds in predictions],
+                    "scores": [[pred[2] for pred in preds] for preds in predictions],
+                },
+                schema=self._schema,
+            )
+            path = os.path.join(self._directory, "part-{:05d}.parquet".format(self._parts))
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+            os.close(fd)
+            self._pyarrow.parquet.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+            self._parts += 1
+            self._records = []
+        return self._parts
+
+    def close(self):
+        pass
+
+
+_WRITERS = {"jsonl": _JsonLinesWriter, "parquet": _ParquetWriter}
+
+
+def _checkpoint_path(output):
+    return output.rstrip(os.sep) + ".checkpoint.json"
+
+
+def _load_checkpoint(output, source, restart):
+    path = _checkpoint_path(output)
+    if restart or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["source"] != os.path.abspath(source):
+        raise ValueError(
+            "{} belongs to {}, pass restart=True to score {} from the start".format(
+                path, checkpoint["source"], source
+            )
+        )
+    return checkpoint
+
+
+def _save_checkpoint(output, checkpoint):
+    path = _checkpoint_path(output)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(checkpoint, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _read_batches(source, skip, batch_size, batches, stop):
+    """ Put lists of (key, bytes) on the batches queue, then _DONE or the error raised
+    """
+    try:
+        images = iter_images(source, skip)
+        batch = list(islice(images, batch_size))
+        while batch and not stop.is_set():
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            batch = list(islice(images, batch_size))
+        if not stop.is_set():
+            batches.put(_DONE)
+    except Exception as error:
+        batches.put(error)
+
+
+def _statistics(images, errors, seconds, wait_seconds, predict_seconds):
+    return {
+        "images": images,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "images_per_second": round(images / seconds, 2) if seconds else 0.0,
+        # Time the model waited for decoded batches, high if decoding is the bottleneck
+        "decode_wait_seconds": round(wait_seconds, 3),
+        "predict_seconds": round(predict_seconds, 3),
+    }
+
+
+def score_images(
+    model,
+    source,
+    output,
+    labels,
+    output_format=None,
+    batch_size=32,
+    workers=4,
+    prefetch=4,
+    top=3,
+    checkpoint_every=5000,
+    restart=False,
+):
+    """ Score every image of source and write the predictions to output
+
+    Keyword arguments:
+    model -- model whose predict() takes a batch of preprocessed images
+    source -- directory or tar archive of images, see iter_images
+    output -- JSON lines file, or directory of Parquet parts
+    labels -- (wordnet id, name) of every class, see response_format.imagenet_labels
+    output_format -- "jsonl" or "parquet", has to match the checkpoint when
+        resuming (default parquet if output ends with .parquet, else jsonl)
+    batch_size -- images per model.predict (default 32)
+    workers -- threads decoding batches (default 4)
+    prefetch -- batches read and decoded ahead of the model (default 4)
+    top -- number of classes per image (default 3)
+    checkpoint_every -- images between checkpoints (default 5000)
+    restart -- ignore the checkpoint of a previous run (default False)
+
+    Returns the counters of this run as a dict.
+    """
+    logger = logging.getLogger("model_driver")
+    checkpoint = _load_checkpoint(output, source, restart)
+    if checkpoint is not None and checkpoint["complete"]:
+        logger.info("{} has been scored completely already".format(source))
+        return _statistics(0, 0, 0.0, 0.0, 0.0)
+    if checkpoint is not None and output_format not in (None, checkpoint["format"]):
+        raise ValueError(
+            "{} was written as {}, pass restart=True to write it as {}".format(
+                output, checkpoint["format"], output_format
+            )
+        )
+    if checkpoint is None:
+        checkpoint = {
+            "source": os.path.abspath(source),
+            "format": output_format or ("parquet" if output.rstrip(os.sep).endswith(".parquet") else "jsonl"),
+            "images": 0,
+            "errors": 0,
+            "writer_state": None,
+            "complete": False,
+        }
+    writer = _WRITERS[checkpoint["format"]](output, checkpoint["writer_state"])
+
+    local = threading.local()
+
+    def decode(batch):
+        """ Keys, preprocessed images that could be decoded and errors of the others
+        """
+        preprocess = getattr(local, "preprocess", None)
+        if preprocess is None:
+            preprocess = local.preprocess = BatchPreprocessor()
+        width, height = preprocess.target_size
+        uint8_batch = np.empty((len(batch), height, width, 3), dtype=np.uint8)
+        decoded, errors = 0, {}
+        for key, data in batch:
+            try:
+                preprocess.decode_into(BytesIO(data), uint8_batch[decoded])
+                decoded += 1
+            except Exception as error:
+                errors[key] = "Unable to decode image ({})".format(type(error).__name__)
+        if decoded:
+            # normalise reuses its buffer, and the batch waits for the model
+            images = np.array(preprocess.normalise(uint8_batch[:decoded]))
+        else:
+            images = np.empty((0, height, width, 3), dtype=np.float32)
+        return [key for key, _ in batch], images, errors
+
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_read_batches,
+        args=(source, checkpoint["images"], batch_size, batches, stop),
+        name="bulk-reader",
+        daemon=True,
+    )
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-decode")
+    pending = deque()
+    images = errors = since_checkpoint = 0
+    wait_seconds = predict_seconds = 0.0
+    start = t.default_timer()
+    reader.start()
+    try:
+        finished = False
+        while True:
+            while not finished and len(pending) < prefetch:
+                batch = batches.get()
+                if batch is _DONE:
+                    finished = True
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    pending.append(executor.submit(decode, batch))
+            if not pending:
+                break
+            waited = t.default_timer()
+            keys, batch, batch_errors = pending.popleft().result()
+            predicted = t.default_timer()
+            wait_seconds += predicted - waited
+            preds = iter(top_k_lists(model.predict(batch), top) if len(batch) else [])
+            predict_seconds += t.default_timer() - predicted
+            writer.write(
+                [
+                    {"key": key, "error": batch_errors[key]}
+                    if key in batch_errors
+                    else {"key": key, "predictions": to_json(next(preds), labels)}
+                    for key in keys
+                ]
+            )
+            checkpoint["images"] += len(keys)
+            checkpoint["errors"] += len(batch_errors)
+            images += len(keys)
+            errors += len(batch_errors)
+            since_checkpoint += len(keys)
+            if since_checkpoint >= checkpoint_every:
+                checkpoint["writer_state"] = writer.checkpoint()
+                _save_checkpoint(output, checkpoint)
+                since_checkpoint = 0
+                logger.info(
+                    "{} images scored, {:.1f} images/s".format(
+                        checkpoint["images"], images / (t.default_timer() - start)
+                    )
+                )
+        checkpoint["writer_state"] = writer.checkpoint()
+        checkpoint["complete"] = True
+        _save_checkpoint(output, checkpoint)
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+        writer.close()
+    return _statistics(
+        images, errors, t.default_timer() - start, wait_seconds, predict_seconds
+    )
+
+
+def _load_model(model_path, depth):
+    """ The model the driver would load, or a randomly initialised one if model_path is None
+    """
+    from benchmark import _offline_class_index, ensure_driver
+
+    ensure_driver()
+    import driver
+
+    driver._configure_session()
+    if model_path is not None:
+        return driver._load_model(model_path, depth)
+    from resnet152 import ResNet, fuse_for_inference
+
+    _offline_class_index()
+    return fuse_for_inference(ResNet(depth, weights=None))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from response_format import imagenet_labels
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("source", help="directory or tar archive of images")
+    parser.add_argument("output", help="JSON lines file or directory of Parquet parts")
+    parser.add_argument("--format", choices=sorted(_WRITERS),
+                        help="output format, by default parquet if output ends with .parquet")
+    parser.add_argument("--model", help="model artifact or HDF5 weights")
+    parser.add_argument("--depth", type=int, choices=(50, 101, 152), default=152,
+                        help="depth of the ResNet the HDF5 weights belong to")
+    parser.add_argument("--random-weights", action="store_true",
+                        help="score with a randomly initialised model, for timing")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="threads decoding batches")
+    parser.add_argument("--prefetch", type=int, default=4, help="batches decoded ahead of the model")
+    parser.add_argument("--top", type=int, default=3)
+    parser.add_argument("--checkpoint-every", type=int, default=5000, help="images between checkpoints")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous run")
+    args = parser.parse_args()
+    if args.model is None and not args.random_weights:
+        parser.error("either --model or --random-weights is required")
+
+    logging.basicConfig(level=logging.INFO)
+    stats = score_images(
+        _load_model(args.model, args.depth),
+        args.source,
+        args.output,
+        imagenet_labels(),
+        output_format=args.format,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        prefetch=args.prefetch,
+        top=args.top,
+        checkpoint_every=args.checkpoint_every,
+        restart=args.restart,
+    )
+    print(
+        "{images} images ({errors} errors) in {seconds:.1f} s: {images_per_second:.1f} images/s, "
+        "model waited {decode_wait_seconds:.1f} s for decoding".format(**stats)
+    )
@@ -0,0 +1,184 @@
+"""Confidence based cascade of a shallower ResNet in front of ResNet152.
+
+Many images are classified with high confidence by a much cheaper network. A
+Cascade scores every batch with the cheap model first and only sends the
+images whose best class has a probability below the threshold on to the full
+model. Escalated images get the predictions of the full model, exactly as
+without the cascade; the other images get those of the cheap model.
+
+Run this module directly to measure the escalation rate and the latency saved
+at a few thresholds, and to check that escalated images get the predictions of
+the full model:
+
+    python cascade.py --images images/ --cheap-weights resnet50_weights.h5 \\
+        --weights model_resnet_weights.h5 --thresholds 0.5,0.7,0.9
+
+Without weights both models are randomly initialised, which only makes sense
+for timing.
+
+"""
+import threading
+import timeit as t
+
+import numpy as np
+
+
+class CascadeStatistics(object):
+    """ Thread safe counters of the images scored and escalated by a Cascade
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._batches = 0
+            self._images = 0
+            self._escalated = 0
+            self._cheap_seconds = 0.0
+            self._full_seconds = 0.0
+
+    def record(self, batch_size, escalated, cheap_seconds, full_seconds):
+        with self._lock:
+            self._batches += 1
+            self._images += batch_size
+            self._escalated += escalated
+            self._cheap_seconds += cheap_seconds
+            self._full_seconds += full_seconds
+
+    def snapshot(self):
+        """ Return the counters as a JSON serializable dict
+
+        The latency saved per image is estimated from the time the full model
+        took per escalated image, as if it had scored every image.
+        """
+        with self._lock:
+            images = max(self._images, 1)
+            cascade_ms = (self._cheap_seconds + self._full_seconds) * 1000 / images
+            snapshot = {
+                "batches": self._batches,
+                "images": self._images,
+                "escalated": self._escalated,
+                "escalation_rate": round(self._escalated / images, 4),
+                "mean_cascade_ms_per_image": round(cascade_ms, 3),
+            }
+            if self._escalated:
+                full_ms = self._full_seconds * 1000 / self._escalated
+                snapshot["mean_full_ms_per_image"] = round(full_ms, 3)
+                snapshot["mean_latency_saved_ms_per_image"] = round(full_ms - cascade_ms, 3)
+            return snapshot
+
+
+class Cascade(object):
+    """ Model like object that escalates uncertain images to the full model
+
+    Keyword arguments:
+    cheap_model -- model scored first, e.g. ResNet(50)
+    model -- the full model, e.g. ResNet152
+    threshold -- images whose best class has a lower probability in the
+        predictions of cheap_model are scored by model. 0 never escalates
+        and anything above 1 always does. (default 0.8)
+
+    """
+
+    def __init__(self, cheap_model, model, threshold=0.8):
+        self.cheap_model = cheap_model
+        self.model = model
+        self.threshold = threshold
+        self.statistics = CascadeStatistics()
+
+    def escalated(self, preds):
+        """ Indices of the rows of cheap_model predictions to score with model
+        """
+        return np.flatnonzero(preds.max(axis=1) < self.threshold)
+
+    def predict(self, batch):
+        start = t.default_timer()
+        preds = self.cheap_model.predict(batch)
+        cheap_end = t.default_timer()
+        escalated = self.escalated(preds)
+        if len(escalated):
+            preds[escalated] = self.model.predict(batch[escalated])
+        end = t.default_timer()
+        self.statistics.record(len(batch), len(escalated), cheap_end - start, end - cheap_end)
+        return preds
+
+
+def _benchmark(image_paths, cheap_weights, weights, cheap_depth, thresholds, batch_size):
+    from preprocessing import BatchPreprocessor
+    from resnet152 import ResNet, fuse_for_inference
+
+    cheap_model = ResNet(cheap_depth)
+    model = ResNet(152)
+    if cheap_weights is not None:
+        cheap_model.load_weights(cheap_weights)
+    if weights is not None:
+        model.load_weights(weights)
+    cheap_model, model = fuse_for_inference(cheap_model), fuse_for_inference(model)
+
+    preprocess = BatchPreprocessor()
+    batches = [
+        np.array(preprocess(image_paths[start : start + batch_size]))
+        for start in range(0, len(image_paths), batch_size)
+    ]
+    for batch in batches:
+        # Warm up every batch size of both models
+        model.predict(batch)
+        cheap_model.predict(batch)
+        for size in range(1, len(batch) + 1):
+            model.predict(batch[:size])
+
+    start = t.default_timer()
+    full_preds = [model.predict(batch) for batch in batches]
+    full_ms = (t.default_timer() - start) * 1000 / len(image_paths)
+    print("ResNet152 alone {0:8.2f} ms/image".format(full_ms))
+
+    for threshold in thresholds:
+        cascade = Cascade(cheap_model, model, threshold)
+        start = t.default_timer()
+        cascade_preds = [cascade.predict(batch) for batch in batches]
+        cascade_ms = (t.default_timer() - start) * 1000 / len(image_paths)
+        max_abs_diff = 0.0
+        for batch, preds, reference in zip(batches, cascade_preds, full_preds):
+            escalated = cascade.escalated(cheap_model.predict(batch))
+            if len(escalated):
+                max_abs_diff = max(
+                    max_abs_diff,
+                    float(np.max(np.abs(preds[escalated] - reference[escalated]))),
+                )
+        stats = cascade.statistics.snapshot()
+        print(
+            "threshold {0:4.2f}: escalated {1:6.1%}  {2:8.2f} ms/image  saved {3:8.2f} ms/image  "
+            "max abs diff of escalated images {4:.2e}".format(
+                threshold, stats["escalation_rate"], cascade_ms, full_ms - cascade_ms, max_abs_diff
+            )
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--images", required=True, help="directory of images to score")
+    parser.add_argument("--cheap-weights", help="HDF5 weights of the cheap model")
+    parser.add_argument("--cheap-depth", type=int, choices=(50, 101), default=50)
+    parser.add_argument("--weights", help="HDF5 weights of ResNet152")
+    parser.add_argument("--thresholds", default="0.5,0.7,0.9",
+                        help="comma separated confidence thresholds")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    paths = sorted(
+        os.path.join(args.images, name)
+        for name in os.listdir(args.images)
+        if name.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+    _benchmark(
+        paths,
+        args.cheap_weights,
+        args.weights,
+        args.cheap_depth,
+        [float(threshold) for threshold in args.thresholds.split(",")],
+        args.batch_size,
+    )
@@ -0,0 +1,190 @@
+"""Low overhead latency histograms exposed in the Prometheus text format.
+
+The model driver records how long every scoring stage takes and the size of
+every batch it scores. A MetricsRegistry keeps one histogram with fixed bucket
+boundaries per metric and label value, so recording a value is a bisect and
+three additions, and renders them in the Prometheus text exposition format.
+A disabled registry records nothing and its timers do not read the clock.
+
+Run this module directly to measure the overhead of recording:
+
+    python metrics.py --observations 1000000
+
+and compare the end-to-end cost with METRICS_ENABLED=False python benchmark.py.
+
+"""
+import threading
+import timeit as t
+from bisect import bisect_left
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Histogram(object):
+    """ Counts of observed values per bucket, with their sum
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """ Return the cumulative bucket counts, ending with +Inf, and the sum
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = t.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(t.default_timer() - self._start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Family(object):
+    def __init__(self, help_text, buckets, label):
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self.children = OrderedDict()
+
+
+class MetricsRegistry(object):
+    """ Named histograms, optionally split by the value of one label
+
+    Keyword arguments:
+    enabled -- if False nothing is recorded and render returns an empty string
+        (default True)
+
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._families = OrderedDict()
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, label=None):
+        """ Declare a histogram, label is the name of its optional label
+        """
+        self._families[name] = _Family(help_text, buckets, label)
+
+    def reset(self):
+        """ Drop all observations, the declared histograms are kept
+        """
+        with self._lock:
+            for family in self._families.values():
+                family.children = OrderedDict()
+
+    def _child(self, name, label_value):
+        family = self._families[name]
+        child = family.children.get(label_value)
+        if child is None:
+            with self._lock:
+                child = family.children.setdefault(label_value, Histogram(family.buckets))
+        return child
+
+    def observe(self, name, value, label_value=""):
+        if self.enabled:
+            self._child(name, label_value).observe(value)
+
+    def timer(self, name, label_value=""):
+        """ Context manager that observes the time spent in its block in seconds
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self._child(name, label_value))
+
+    def observer(self, name):
+        """ Function observing values of a labelled histogram, None when disabled
+        """
+        if not self.enabled:
+            return None
+        return lambda label_value, value: self.observe(name, value, label_value)
+
+    def render(self):
+        """ All histograms in the Prometheus text exposition format
+        """
+        if not self.enabled:
+            return ""
+        lines = []
+        for name, family in list(self._families.items()):
+            lines.append("# HELP {} {}".format(name, family.help_text))
+            lines.append("# TYPE {} histogram".format(name))
+            for label_value, histogram in list(family.children.items()):
+                labels = (
+                    '{}="{}",'.format(family.label, label_value) if family.label else ""
+                )
+                cumulative, total = histogram.snapshot()
+                bounds = [repr(float(b)) for b in family.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, cumulative):
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, count))
+                labels = "{" + labels.rstrip(",") + "}" if labels else ""
+                lines.append("{}_sum{} {}".format(name, labels, repr(total)))
+                lines.append("{}_count{} {}".format(name, labels, cumulative[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def _benchmark(observations):
+    for enabled in (True, False):
+        registry = MetricsRegistry(enabled=enabled)
+        registry.histogram("stage_seconds", "benchmark", label="stage")
+
+        def observe():
+            for _ in range(observations):
+                registry.observe("stage_seconds", 0.003, "predict")
+
+        def time_block():
+            for _ in range(observations):
+                with registry.timer("stage_seconds", "predict"):
+                    pass
+
+        for name, func in (("observe", observe), ("timer", time_block)):
+            seconds = min(t.repeat(func, repeat=3, number=1))
+            print(
+                "{0:<8} enabled={1!s:<5} {2:8.0f} ns per call".format(
+                    name, enabled, seconds * 1e9 / observations
+                )
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--observations", type=int, default=1000000)
+    args = parser.parse_args()
+    _benchmark(args.observations)
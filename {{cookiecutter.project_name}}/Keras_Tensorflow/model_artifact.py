@@ -0,0 +1,295 @@
+"""Single file, memory mappable model artifact for fast cold starts.
+
+Loading the model from the HDF5 weights means building the full 152 layer
+graph, parsing the HDF5 file and folding the normalization layers on every
+start of the scoring container. An artifact written by `export_model` holds the
+ResNet arguments and the (already fused) weights in one flat file:
+
+    magic (8 bytes) | header length (uint64, little endian) | JSON header | weights
+
+Every weight array is stored C contiguous at a 64 byte aligned offset, so
+`load_model` can build the much shallower fused graph and assign the weights
+straight from a read only memory map of the file, without reading the file
+into memory first.
+
+With share_weights the weights are not even copied into TensorFlow variables:
+the model reads them straight from the memory map on every prediction, see
+SharedWeightsModel, so all the processes that load the same artifact share a
+single copy of the weights in the page cache.
+
+For a model that computes in int8, see quantized_model.py.
+
+Export the weights registered with the workspace:
+
+    python model_artifact.py export --weights model_resnet_weights.h5 --output model_resnet152.bin
+
+Compare the startup time and peak memory of both loading paths, with random
+weights when no files are given:
+
+    python model_artifact.py benchmark [--weights model_resnet_weights.h5 --artifact model_resnet152.bin]
+
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+_MAGIC = b"RN152MA1"
+_ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def is_model_artifact(path):
+    """ True if path is a file written by export_model
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(_MAGIC)) == _MAGIC
+    except OSError:
+        return False
+
+
+def export_model(model, path):
+    """ Write a ResNet model to a single file artifact
+
+    The BatchNormalization and Scale layers are folded into the convolutions
+    before the weights are written, see resnet152.fuse_for_inference.
+    """
+    from resnet152 import fuse_for_inference, resnet152_config
+
+    model = fuse_for_inference(model)
+    entries, arrays = [], []
+    offset = 0
+    for layer in model.layers:
+        for index, weight in enumerate(layer.get_weights()):
+            array = np.ascontiguousarray(weight, dtype=weight.dtype.newbyteorder("<"))
+            entries.append(
+                {
+                    "layer": layer.name,
+                    "index": index,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "offset": offset,
+                }
+            )
+            arrays.append(array)
+            offset = _aligned(offset + array.nbytes)
+
+    header = json.dumps(
+        {"config": resnet152_config(model), "weights": entries}
+    ).encode("utf-8")
+    data_start = _aligned(len(_MAGIC) + 8 + len(header))
+    with open(path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for entry, array in zip(entries, arrays):
+            f.seek(data_start + entry["offset"])
+            f.write(array.tobytes())
+    return path
+
+
+class SharedWeightsModel(object):
+    """ ResNet that reads its weights from the memory map of an artifact on every prediction
+
+    The model is built in a graph of its own whose variables are never
+    initialised. Instead, the tensors the layers read the variables through are
+    fed with the memory mapped weights. TensorFlow uses fed numpy arrays whose
+    data is 64 byte aligned without copying them, so the weights are only ever
+    held in the page cache, which every process that maps the artifact shares.
+
+    Keyword arguments:
+    model -- Keras model built with ResNet in graph
+    graph -- the graph of the model
+    weights -- memory mapped array of every variable of the model, in the order
+        of model.layers and layer.weights
+    session_config -- tf.ConfigProto of the session, e.g. with the sizes of the
+        thread pools. (default None)
+
+    """
+
+    def __init__(self, model, graph, weights, session_config=None):
+        import tensorflow as tf
+
+        self.model = model
+        self.input_shape = model.input_shape
+        self._weights = list(weights)
+        self._session = tf.Session(graph=graph, config=session_config)
+        variables = [variable for layer in model.layers for variable in layer.weights]
+        # value() is the tensor that the convolutions and dense layers read a
+        # variable through, feeding it leaves the variable itself out of the run
+        self._predict = self._session.make_callable(
+            model.outputs[0],
+            feed_list=[model.inputs[0]] + [variable.value() for variable in variables],
+        )
+
+    def predict(self, batch, batch_size=None):
+        """ Probabilities of the classes of every image of a preprocessed batch
+        """
+        return self._predict(np.asarray(batch, dtype=np.float32), *self._weights)
+
+
+def load_model(path, share_weights=False, session_config=None):
+    """ Build the model stored in an artifact and assign its memory mapped weights
+
+    Keyword arguments:
+    path -- artifact written by export_model
+    share_weights -- return a SharedWeightsModel that reads the weights from
+        the memory map instead of copying them into the variables of a Keras
+        model. (default False)
+    session_config -- tf.ConfigProto of the session of a SharedWeightsModel.
+        (default None)
+
+    """
+    import keras.backend as K
+    from resnet152 import ResNet
+
+    with open(path, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("{} is not a model artifact".format(path))
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _aligned(len(_MAGIC) + 8 + header_length)
+
+    config = header["config"]
+    config["input_shape"] = tuple(config["input_shape"])
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    weights = {
+        (entry["layer"], entry["index"]): np.ndarray(
+            tuple(entry["shape"]),
+            dtype=np.dtype(entry["dtype"]),
+            buffer=data,
+            offset=data_start + entry["offset"],
+        )
+        for entry in header["weights"]
+    }
+
+    if share_weights:
+        import tensorflow as tf
+
+        graph = tf.Graph()
+        with graph.as_default():
+            model = ResNet(weights=None, **config)
+        return SharedWeightsModel(
+            model,
+            graph,
+            [
+                weights[(layer.name, index)]
+                for layer in model.layers
+                for index in range(len(layer.weights))
+            ],
+            session_config,
+        )
+    model = ResNet(weights=None, **config)
+    K.batch_set_value(
+        [
+            (variable, weights[(layer.name, index)])
+            for layer in model.layers
+            for index, variable in enumerate(layer.weights)
+        ]
+    )
+    return model
+
+
+def _image_paths(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+
+
+def _measure(kind, path):
+    """ Load a model in a fresh process and print the time and peak RSS as JSON
+    """
+    import resource
+    import timeit as t
+
+    start = t.default_timer()
+    if kind == "artifact":
+        load_model(path)
+    else:
+        from resnet152 import ResNet152, fuse_for_inference
+
+        model = ResNet152()
+        model.load_weights(path)
+        fuse_for_inference(model)
+    seconds = t.default_timer() - start
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"seconds": round(seconds, 3), "peak_rss_mb": round(peak_rss, 1)}))
+
+
+def _benchmark(weights_path, artifact_path, repeats):
+    import subprocess
+    import sys
+    import tempfile
+
+    if weights_path is None:
+        from resnet152 import ResNet152
+
+        tmp_dir = tempfile.mkdtemp()
+        model = ResNet152(weights=None)
+        weights_path = os.path.join(tmp_dir, "model_resnet_weights.h5")
+        model.save_weights(weights_path)
+        if artifact_path is None:
+            artifact_path = export_model(model, os.path.join(tmp_dir, "model_resnet152.bin"))
+    if artifact_path is None:
+        raise ValueError("--artifact is required when --weights is given")
+
+    for kind, path in (("hdf5", weights_path), ("artifact", artifact_path)):
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "_measure", kind, path]
+            )
+            runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+        print(
+            "{0:<9} load time {1:6.2f} s  peak RSS {2:7.1f} MB".format(
+                kind,
+                min(run["seconds"] for run in runs),
+                min(run["peak_rss_mb"] for run in runs),
+            )
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="convert HDF5 weights to an artifact")
+    export_parser.add_argument("--weights")
+    export_parser.add_argument("--random-weights", action="store_true",
+                               help="export a randomly initialised model, e.g. for benchmarks")
+    export_parser.add_argument("--output", default="model_resnet152.bin")
+    export_parser.add_argument("--depth", type=int, choices=(50, 101, 152), default=152,
+                               help="depth of the ResNet the weights belong to")
+    benchmark_parser = commands.add_parser("benchmark", help="compare startup time and memory")
+    benchmark_parser.add_argument("--weights")
+    benchmark_parser.add_argument("--artifact")
+    benchmark_parser.add_argument("--repeats", type=int, default=3)
+    measure_parser = commands.add_parser("_measure")
+    measure_parser.add_argument("kind", choices=("hdf5", "artifact"))
+    measure_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from resnet152 import ResNet
+
+        if args.weights is None and not args.random_weights:
+            parser.error("--weights or --random-weights is required")
+        model = ResNet(args.depth)
+        if args.weights is not None:
+            model.load_weights(args.weights)
+        print("Wrote", export_model(model, args.output))
+    elif args.command == "benchmark":
+        _benchmark(args.weights, args.artifact, args.repeats)
+    elif args.command == "_measure":
+        _measure(args.kind, args.path)
+    else:
+        parser.print_help()
@@ -0,0 +1,296 @@
+"""Reuse of the predictions of near duplicate images for the model driver.
+
+A lot of traffic consists of near identical frames: images that were encoded
+again or changed in a few pixels, which the PredictionCache misses because it
+keys predictions by the exact bytes. The NearDuplicateIndex keys predictions
+by a 64 bit perceptual hash of the decoded 224x224 image instead:
+
+- the image is converted to grayscale and averaged down to 32x32,
+- the 8x8 lowest frequencies of its 2D DCT are compared to their median, one
+  bit per frequency.
+
+Small changes of pixels, brightness or JPEG quality flip few, if any, of the
+bits, so images whose hashes differ in at most max_distance bits get the
+predictions stored for the nearest hash. The index is a bounded ring of hashes
+that is searched exhaustively for the smallest Hamming distance, which takes
+well under a millisecond per image for ten thousand entries.
+
+Reuse is approximate, so run this module to measure the hit rate and the false
+reuse rate at a few distances before enabling it:
+
+    python near_duplicates.py --images images/ --variations 20 --distances 0,2,4,6,8,10
+
+Half of the images are indexed. Variations of those should be reused, while
+variations of the other half should not, and any reuse of the predictions of
+another image is a false reuse. With --weights the share of reused predictions
+whose best class differs from that of the image itself is measured as well.
+
+"""
+import threading
+import timeit as t
+
+import numpy as np
+
+_POOLED_SIZE = 32
+_HASH_SIZE = 8
+_GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _dct_matrix(size):
+    # Unnormalised DCT-II, the scale does not matter when comparing to the median
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size)).astype(np.float32)
+
+
+_DCT = _dct_matrix(_POOLED_SIZE)
+
+
+def perceptual_hash(images):
+    """ 64 bit perceptual hashes of a batch of uint8 RGB images, as uint64
+
+    The images have to be at least 32x32, e.g. the uint8 batch returned by
+    BatchPreprocessor.decode.
+    """
+    images = np.asarray(images)
+    num, height, width, _ = images.shape
+    # Sum blocks of pixels by adding strided views, much faster than a
+    # reduction over a reshaped array. The grayscale conversion is linear, so
+    # it is applied to the 32x32 sums only.
+    rows, columns = height // _POOLED_SIZE, width // _POOLED_SIZE
+    images = images[:, : rows * _POOLED_SIZE, : columns * _POOLED_SIZE]
+    row_sums = images[:, 0::rows].astype(np.uint32)
+    for offset in range(1, rows):
+        row_sums += images[:, offset::rows]
+    pooled = row_sums[:, :, 0::columns].copy()
+    for offset in range(1, columns):
+        pooled += row_sums[:, :, offset::columns]
+    pooled = np.dot(pooled.astype(np.float32), _GRAY_WEIGHTS)
+    frequencies = np.matmul(np.matmul(_DCT, pooled), _DCT.T)
+    low = frequencies[:, :_HASH_SIZE, :_HASH_SIZE].reshape(num, -1)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def hamming_distances(hashes, others):
+    """ Matrix of the number of differing bits of every pair of hashes
+    """
+    x = np.bitwise_xor(
+        np.asarray(hashes, dtype=np.uint64)[:, None], np.asarray(others, dtype=np.uint64)[None, :]
+    )
+    # Count the set bits of every 64 bit difference in parallel
+    x -= (x >> np.uint64(1)) & np.uint64(0x5555555555555555)
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int32)
+
+
+class NearDuplicateIndex(object):
+    """ Bounded, thread safe index of perceptual hashes and the predictions of their images
+
+    Keyword arguments:
+    max_distance -- lookup returns the predictions of the nearest hash if it
+        differs in at most this many of the 64 bits, a negative distance never
+        matches. (default 4)
+    max_entries -- the oldest entries are replaced once the index holds this
+        many. (default 10000)
+
+    """
+
+    def __init__(self, max_distance=4, max_entries=10000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Drop all entries and reset the counters
+        """
+        with self._lock:
+            self._hashes = np.zeros(self.max_entries, dtype=np.uint64)
+            self._values = [None] * self.max_entries
+            self._size = 0
+            self._next = 0
+            self._hits = 0
+            self._misses = 0
+            self._hit_distances = 0
+
+    def _nearest(self, hashes):
+        """ Position and distance of the nearest entry of every hash, -1 and 65 if empty
+
+        The lock has to be held.
+        """
+        if not self._size:
+            return np.full(len(hashes), -1), np.full(len(hashes), 65)
+        distances = hamming_distances(hashes, self._hashes[: self._size])
+        positions = distances.argmin(axis=1)
+        return positions, distances[np.arange(len(hashes)), positions]
+
+    def lookup(self, hashes):
+        """ Stored predictions of the nearest entry within max_distance of every hash, else None
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.max_distance < 0:
+            return [None] * len(hashes)
+        with self._lock:
+            # The ring is overwritten by add, so the nearest entries and their
+            # predictions have to be read under the same acquisition
+            positions, distances = self._nearest(hashes)
+            values = [
+                self._values[position] if distance <= self.max_distance else None
+                for position, distance in zip(positions, distances)
+            ]
+            hits = distances[distances <= self.max_distance]
+            self._hits += len(hits)
+            self._misses += len(hashes) - len(hits)
+            self._hit_distances += int(hits.sum())
+        return values
+
+    def add(self, hashes, values):
+        """ Store the predictions of the images with the given hashes
+        """
+        with self._lock:
+            for image_hash, value in zip(hashes, values):
+                self._hashes[self._next] = image_hash
+                self._values[self._next] = value
+                self._next = (self._next + 1) % self.max_entries
+                self._size = min(self._size + 1, self.max_entries)
+
+    def statistics(self):
+        """ Return the counters as a JSON serializable dict
+        """
+        with self._lock:
+            lookups = max(self._hits + self._misses, 1)
+            return {
+                "entries": self._size,
+                "max_distance": self.max_distance,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4),
+                "mean_hit_distance": round(self._hit_distances / max(self._hits, 1), 3),
+            }
+
+
+def _source_images(image_dir, num_images):
+    """ JPEG bytes and PIL images of the images in image_dir or of smooth random ones
+    """
+    from io import BytesIO
+
+    from PIL import Image
+
+    if image_dir is not None:
+        from model_artifact import _image_paths
+
+        datas = []
+        for path in _image_paths(image_dir):
+            with open(path, "rb") as f:
+                datas.append(f.read())
+    else:
+        rng = np.random.RandomState(0)
+        datas = []
+        for _ in range(num_images):
+            base = rng.randint(0, 255, size=(24, 32, 3)).astype(np.uint8)
+            img = Image.fromarray(base).resize((640, 480), Image.BICUBIC)
+            imgio = BytesIO()
+            img.save(imgio, "JPEG", quality=95)
+            datas.append(imgio.getvalue())
+    return datas, [Image.open(BytesIO(data)).convert("RGB") for data in datas]
+
+
+def _benchmark(image_dir, num_images, num_variations, distances, weights, max_entries):
+    from io import BytesIO
+
+    from preprocessing import BatchPreprocessor
+    from testing_utilities import iter_variations_of_one_image
+
+    datas, images = _source_images(image_dir, num_images)
+    indexed = (len(datas) + 1) // 2
+    preprocess = BatchPreprocessor()
+    model = None
+    if weights is not None:
+        from resnet152 import ResNet152, fuse_for_inference
+
+        model = ResNet152(weights=None)
+        model.load_weights(weights)
+        model = fuse_for_inference(model)
+
+    hash_seconds = []
+
+    def hash_and_classify(batch):
+        uint8_batch = preprocess.decode([BytesIO(data) for data in batch])
+        start = t.default_timer()
+        hashes = perceptual_hash(uint8_batch)
+        hash_seconds.append((t.default_timer() - start) / len(batch))
+        if model is None:
+            return hashes, np.zeros(len(batch), dtype=np.int64)
+        return hashes, model.predict(preprocess.normalise(uint8_batch)).argmax(axis=1)
+
+    source_hashes, source_classes = hash_and_classify(datas[:indexed])
+    query_sources, query_hashes, query_classes = [], [], []
+    kinds = ("pixel", "brightness", "noise", "roll")
+    for source, image in enumerate(images):
+        variations = list(iter_variations_of_one_image(image, num_variations, kinds=kinds, seed=source))
+        hashes, classes = hash_and_classify(variations)
+        query_sources.extend([source] * len(variations))
+        query_hashes.append(hashes)
+        query_classes.append(classes)
+    query_sources = np.array(query_sources)
+    query_hashes = np.concatenate(query_hashes)
+    query_classes = np.concatenate(query_classes)
+
+    matrix = hamming_distances(query_hashes, source_hashes)
+    matches = matrix.argmin(axis=1)
+    nearest = matrix[np.arange(len(matches)), matches]
+    of_indexed = query_sources < indexed
+    print(
+        "{} images, {} indexed, {} variations each, hash {:.1f} us/image".format(
+            len(datas), indexed, num_variations, np.median(hash_seconds) * 1e6
+        )
+    )
+    print(
+        "distance  hit rate (indexed)  hit rate (others)  false reuse{}".format(
+            "  best class changed" if model is not None else ""
+        )
+    )
+    for distance in distances:
+        hits = nearest <= distance
+        false_hits = hits & (matches != query_sources)
+        line = "{0:8d}  {1:18.1%}  {2:17.1%}  {3:11.2%}".format(
+            distance,
+            hits[of_indexed].mean(),
+            hits[~of_indexed].mean() if (~of_indexed).any() else 0.0,
+            false_hits.sum() / max(hits.sum(), 1),
+        )
+        if model is not None:
+            changed = hits & (source_classes[matches] != query_classes)
+            line += "  {0:18.2%}".format(changed.sum() / max(hits.sum(), 1))
+        print(line)
+
+    index = NearDuplicateIndex(max_distance=max(distances), max_entries=max_entries)
+    rng = np.random.RandomState(1)
+    index.add(rng.randint(0, 2 ** 63, size=max_entries, dtype=np.int64).astype(np.uint64), range(max_entries))
+    batch = query_hashes[:8]
+    best = min(t.repeat(lambda: index.lookup(batch), repeat=5, number=10)) / 10
+    print("Lookup in a full index of {} entries: {:.1f} us/image".format(max_entries, best * 1e6 / len(batch)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--images", help="directory of images, random images if not given")
+    parser.add_argument("--num-images", type=int, default=20, help="number of random images")
+    parser.add_argument("--variations", type=int, default=20, help="variations of every image")
+    parser.add_argument("--distances", default="0,2,4,6,8,10",
+                        help="comma separated maximum Hamming distances")
+    parser.add_argument("--weights", help="HDF5 weights of ResNet152, to compare the best classes")
+    parser.add_argument("--max-entries", type=int, default=10000, help="size of the index for the lookup timing")
+    args = parser.parse_args()
+    _benchmark(
+        args.images,
+        args.num_images,
+        args.variations,
+        [int(distance) for distance in args.distances.split(",")],
+        args.weights,
+        args.max_entries,
+    )
@@ -0,0 +1,158 @@
+"""Content addressed cache of predictions for the model driver.
+
+Clients often send the same image more than once (retries, re-sent thumbnails).
+The PredictionCache keys predictions by a hash of the uploaded bytes so that a
+repeated image is answered without decoding, preprocessing or scoring it.
+Entries live in an in-process LRU bounded by entry count and size and,
+optionally, in a directory shared by all the workers of a container. All
+entries belong to a model version and changing the version invalidates them.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def content_key(data):
+    """ Key of the raw bytes of an uploaded image
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionCache(object):
+    """ Two tier LRU cache of JSON serializable predictions
+
+    Keyword arguments:
+    max_entries -- maximum number of predictions kept in memory (default 10000)
+    max_bytes -- maximum size of the JSON encoded predictions kept in memory
+        (default 64 MB)
+    disk_dir -- optional directory for the on-disk tier. Workers pointing to the
+        same directory share their predictions. (default None)
+    model_version -- version of the model the predictions come from, see
+        `invalidate` (default "")
+
+    """
+
+    def __init__(
+        self, max_entries=10000, max_bytes=64 * 2 ** 20, disk_dir=None, model_version=""
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._logger = logging.getLogger("model_driver")
+        self.model_version = str(model_version)
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self._lock:
+            self._memory_hits = 0
+            self._disk_hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def _version_dir(self):
+        version = hashlib.sha256(self.model_version.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.disk_dir, version)
+
+    def _disk_path(self, key):
+        return os.path.join(self._version_dir(), key[:2], key + ".json")
+
+    def _store_in_memory(self, key, value, size):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self._evictions += 1
+
+    def get(self, key):
+        """ Return the cached predictions for key or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._memory_hits += 1
+                return self._entries[key][0]
+        if self.disk_dir is not None:
+            try:
+                with open(self._disk_path(key)) as f:
+                    encoded = f.read()
+                value = json.loads(encoded)
+            except (OSError, ValueError):
+                pass
+            else:
+                with self._lock:
+                    self._disk_hits += 1
+                    self._store_in_memory(key, value, len(encoded))
+                return value
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key, value):
+        """ Cache value, which has to be JSON serializable, under key
+        """
+        encoded = json.dumps(value)
+        with self._lock:
+            self._store_in_memory(key, value, len(encoded))
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so that other workers never read
+            # a partially written entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "w") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            self._logger.warning("Unable to write prediction cache entry: {}".format(error))
+
+    def invalidate(self, model_version=None):
+        """ Drop all cached predictions
+
+        If model_version is given, the cache switches to it and the on-disk
+        entries of the previous version are removed as well.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if model_version is None or str(model_version) == self.model_version:
+                return
+            previous_dir = None
+            if self.disk_dir is not None:
+                previous_dir = self._version_dir()
+            self.model_version = str(model_version)
+        if previous_dir is not None:
+            shutil.rmtree(previous_dir, ignore_errors=True)
+
+    def statistics(self):
+        """ Return the cache counters as a JSON serializable dict
+        """
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            lookups = max(hits + self._misses, 1)
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": hits,
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": round(hits / lookups, 4),
+                "model_version": self.model_version,
+            }
@@ -0,0 +1,404 @@
+"""Pre-fork multi-worker serving of the model driver.
+
+A single driver process cannot keep all the cores of a node busy, and starting
+N independent copies of it converts and loads the weights N times. The
+PreforkServer prepares the model once in the parent process: HDF5 weights are
+exported to a memory mappable artifact (see model_artifact.py) and the artifact
+is read once so that its pages are in the page cache. The parent then binds the
+listening socket and forks the workers, which all accept connections on it.
+Every worker
+
+- is pinned to its own contiguous set of CPUs,
+- sizes TensorFlow's thread pools and the image decoding threads to that set,
+  so that the workers do not oversubscribe the cores,
+- builds the small fused graph and serves the driver's run() with a
+  model_artifact.SharedWeightsModel, which feeds the weights to TensorFlow
+  straight from the memory map of the artifact instead of copying them into
+  variables.
+
+The weights are therefore held once, in the page cache, whatever the number of
+workers, and no worker copies them when it starts. The benchmark reports the
+private and the file backed RSS of every worker, with shared weights and, for
+comparison, with weights copied into the variables of every worker.
+
+TensorFlow is never imported in the parent: its thread pools do not survive a
+fork, so a session created before forking could not be used by the workers.
+
+Serve the driver with one worker per four cores:
+
+    python prefork.py serve --model model_resnet152.bin --workers 4 --port 8080
+
+Measure the throughput and the memory per worker for a number of workers, with
+shared and with copied weights, and random weights if no model is given:
+
+    python prefork.py benchmark --workers 1,2,4 --concurrency 16 --requests 20 --weights shared,copied
+
+"""
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def cpu_sets(workers, cpus=None):
+    """ Split the CPUs into one contiguous set per worker
+
+    cpus defaults to the CPUs this process may run on. If there are fewer CPUs
+    than workers, every set is empty and the workers are not pinned.
+    """
+    cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+    if workers > len(cpus):
+        return [set() for _ in range(workers)]
+    bounds = [len(cpus) * index // workers for index in range(workers + 1)]
+    return [set(cpus[bounds[i] : bounds[i + 1]]) for i in range(workers)]
+
+
+def prepare_artifact(model_path=None, depth=152, directory=None):
+    """ Path of a model artifact for the workers to memory map
+
+    HDF5 weights, or random weights if model_path is None, are exported in a
+    subprocess so that TensorFlow is not imported in this one.
+    """
+    from model_artifact import is_model_artifact
+
+    if model_path is not None and is_model_artifact(model_path):
+        artifact = model_path
+    else:
+        artifact = os.path.join(directory or tempfile.mkdtemp(), "model_resnet152.bin")
+        command = [
+            sys.executable,
+            os.path.join(_HERE, "model_artifact.py"),
+            "export",
+            "--output",
+            artifact,
+            "--depth",
+            str(depth),
+        ]
+        command += ["--weights", model_path] if model_path else ["--random-weights"]
+        subprocess.check_call(command)
+    # Read the artifact once, the workers then map pages that are already cached
+    with open(artifact, "rb") as f:
+        while f.read(2 ** 24):
+            pass
+    return artifact
+
+
+def _application(driver):
+    from werkzeug.wrappers import Request, Response
+
+    @Request.application
+    def application(request):
+        result = driver.run(request)
+        if isinstance(result, Response):
+            return result
+        return Response(json.dumps(result), mimetype="application/json")
+
+    return application
+
+
+def memory_mb(pid):
+    """ Resident anonymous and file backed memory of a process in MB, Linux only
+    """
+    usage = {}
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("RssAnon", "RssFile"):
+                usage[name] = round(int(value.split()[0]) / 1024, 1)
+    return usage
+
+
+class PreforkServer(object):
+    """ Serves the driver from worker processes forked from this one
+
+    Keyword arguments:
+    model_path -- model artifact the workers load, see prepare_artifact
+    workers -- number of worker processes (default one per CPU)
+    host -- address to listen on (default "0.0.0.0")
+    port -- port to listen on, 0 picks a free one (default 8080)
+    env -- environment variables that configure the driver, they override the
+        thread pool sizes chosen for each worker (default None)
+    pin_cpus -- pin every worker to its own set of CPUs (default True)
+    before_init -- optional function each worker calls before the driver's init()
+
+    """
+
+    def __init__(
+        self,
+        model_path,
+        workers=None,
+        host="0.0.0.0",
+        port=8080,
+        env=None,
+        pin_cpus=True,
+        before_init=None,
+    ):
+        self.model_path = model_path
+        self.workers = workers or len(os.sched_getaffinity(0))
+        self.host = host
+        self.port = port
+        self.env = dict(env or {})
+        self.pin_cpus = pin_cpus
+        self.before_init = before_init
+        self._logger = logging.getLogger("model_driver")
+        self._pids = {}
+        self._stopping = False
+
+    @property
+    def url(self):
+        return "http://{}:{}/score".format(
+            "127.0.0.1" if self.host == "0.0.0.0" else self.host, self.port
+        )
+
+    def start(self):
+        """ Bind the socket and fork the workers
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self._ready_read, self._ready_write = os.pipe()
+        if self.pin_cpus:
+            self._cpu_sets = cpu_sets(self.workers)
+        else:
+            self._cpu_sets = [set() for _ in range(self.workers)]
+        self._stopping = False
+        for index in range(self.workers):
+            self._spawn(index)
+        return self
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._pids[pid] = index
+
+    def _run_worker(self, index):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        os.close(self._ready_read)
+        cpus = self._cpu_sets[index]
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        threads = len(cpus) or max(1, len(os.sched_getaffinity(0)) // self.workers)
+        os.environ.update(
+            MODEL_PATH=self.model_path,
+            SHARE_ARTIFACT_WEIGHTS="True",
+            TF_INTRA_OP_THREADS=str(threads),
+            TF_INTER_OP_THREADS="1",
+            DECODE_WORKERS=str(threads),
+        )
+        os.environ.update(self.env)
+
+        from werkzeug.serving import make_server
+
+        if self.before_init is not None:
+            self.before_init()
+        if _HERE not in sys.path:
+            sys.path.insert(0, _HERE)
+        import driver
+
+        driver.init()
+        server = make_server(
+            self.host, self.port, _application(driver), threaded=True, fd=self._socket.fileno()
+        )
+        os.write(self._ready_write, b"r")
+        server.serve_forever()
+
+    def wait_ready(self, timeout=600, poll_interval=0.5):
+        """ Wait until every worker has loaded the model and accepts requests
+
+        Raises RuntimeError as soon as a worker exits, within poll_interval
+        seconds, or if the workers are not ready after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        ready = 0
+        while ready < self.workers:
+            for pid, index in list(self._pids.items()):
+                finished, status = os.waitpid(pid, os.WNOHANG)
+                if finished:
+                    self._pids.pop(pid)
+                    raise RuntimeError("Worker {} exited with status {}".format(index, status))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError(
+                    "Only {} of {} workers ready after {} s".format(ready, self.workers, timeout)
+                )
+            readable, _, _ = select.select([self._ready_read], [], [], min(remaining, poll_interval))
+            if readable:
+                ready += len(os.read(self._ready_read, self.workers))
+
+    def memory(self):
+        """ memory_mb of every worker
+        """
+        return [memory_mb(pid) for pid in self._pids]
+
+    def serve_forever(self):
+        """ Restart workers that exit until SIGTERM or SIGINT stops the server
+        """
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        signal.signal(signal.SIGINT, lambda *args: self.stop())
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self._pids.pop(pid, None)
+            if index is not None and not self._stopping:
+                self._logger.warning(
+                    "Worker {} exited with status {}, restarting it".format(index, status)
+                )
+                time.sleep(1)
+                self._spawn(index)
+
+    def stop(self):
+        """ Terminate the workers and close the socket
+        """
+        self._stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self._pids):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self._pids.pop(pid, None)
+        self._socket.close()
+        os.close(self._ready_read)
+        os.close(self._ready_write)
+
+
+def _benchmark(
+    worker_counts, concurrency, requests_per_client, num_variations, model_path, output, modes
+):
+    from benchmark import _offline_class_index, ensure_driver, latency_summary, local_image, run_clients
+    from testing_utilities import gen_variations_of_one_image
+
+    ensure_driver()
+    tmp_dir = tempfile.mkdtemp()
+    images = gen_variations_of_one_image("file://" + local_image(tmp_dir), num_variations)
+    artifact = prepare_artifact(model_path, directory=tmp_dir)
+    print("Artifact {:.1f} MB".format(os.path.getsize(artifact) / 2 ** 20))
+    runs = []
+    for mode in modes:
+        for workers in worker_counts:
+            # The prediction cache would answer the repeated variations
+            server = PreforkServer(
+                artifact,
+                workers,
+                host="127.0.0.1",
+                port=0,
+                env={
+                    "PREDICTION_CACHE_ENTRIES": "0",
+                    "SHARE_ARTIFACT_WEIGHTS": str(mode == "shared"),
+                },
+                before_init=_offline_class_index,
+            )
+            server.start()
+            try:
+                server.wait_ready()
+                run_clients(server.url, images, concurrency, 2)
+                latencies, wall_time = run_clients(server.url, images, concurrency, requests_per_client)
+                memory = server.memory()
+            finally:
+                server.stop()
+            run = {
+                "weights": mode,
+                "workers": workers,
+                "concurrency": concurrency,
+                "requests": len(latencies),
+                "throughput_rps": round(len(latencies) / wall_time, 2),
+                "latency_ms": latency_summary(latencies),
+                "memory_mb": memory,
+            }
+            print(
+                "{workers:>3} workers, {weights:<7} weights: {throughput_rps:8.2f} req/s  "
+                "p50 {p50:8.2f} ms  p99 {p99:8.2f} ms  private RSS per worker {private}  "
+                "file backed {file:7.1f} MB".format(
+                    p50=run["latency_ms"]["p50"],
+                    p99=run["latency_ms"]["p99"],
+                    private=", ".join(
+                        "{:.1f} MB".format(usage.get("RssAnon", 0)) for usage in memory
+                    ),
+                    file=sum(usage.get("RssFile", 0) for usage in memory) / workers,
+                    **run
+                )
+            )
+            runs.append(run)
+    with open(output, "w") as f:
+        json.dump({"cpus": len(os.sched_getaffinity(0)), "runs": runs}, f, indent=4, sort_keys=True)
+    print("Results written to", output)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="serve the driver from forked workers")
+    serve_parser.add_argument("--model", help="model artifact or HDF5 weights")
+    serve_parser.add_argument("--depth", type=int, choices=(50, 101, 152), default=152,
+                              help="depth of the ResNet the HDF5 weights belong to")
+    serve_parser.add_argument("--workers", type=int)
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--no-pinning", action="store_true")
+    benchmark_parser = commands.add_parser("benchmark", help="throughput per number of workers")
+    benchmark_parser.add_argument("--workers", default="1,2,4",
+                                  help="comma separated numbers of workers")
+    benchmark_parser.add_argument("--concurrency", type=int, default=16)
+    benchmark_parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    benchmark_parser.add_argument("--variations", type=int, default=100)
+    benchmark_parser.add_argument("--model", help="model artifact or HDF5 weights")
+    benchmark_parser.add_argument("--output", default="prefork_results.json")
+    benchmark_parser.add_argument("--weights", default="shared,copied",
+                                  help="comma separated modes, shared or copied into every worker")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from benchmark import ensure_driver
+
+        logging.basicConfig(level=logging.INFO)
+        ensure_driver()
+        server = PreforkServer(
+            prepare_artifact(args.model, args.depth),
+            args.workers,
+            args.host,
+            args.port,
+            pin_cpus=not args.no_pinning,
+        )
+        server.start()
+        print("Serving {} workers on {}".format(server.workers, server.url))
+        server.serve_forever()
+    elif args.command == "benchmark":
+        _benchmark(
+            [int(workers) for workers in args.workers.split(",")],
+            args.concurrency,
+            args.requests,
+            args.variations,
+            args.model,
+            args.output,
+            args.weights.split(","),
+        )
+    else:
+        parser.print_help()
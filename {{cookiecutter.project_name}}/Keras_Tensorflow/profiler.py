@@ -0,0 +1,251 @@
+"""Per-layer, per-block and per-stage profile of the ResNet forward pass.
+
+Runs a randomly initialised ResNet on synthetic batches, so it works offline,
+and reports for every layer
+
+- the time spent in its TensorFlow ops, from a full trace of the session run,
+- the FLOPs it needs, counting a multiply-add as two,
+- the size of its output activations,
+
+and the same aggregated per residual block (res2a, ..., res5c) and per stage
+(the stem up to pool1, res2 to res5 and the avg_pool and fc1000 head), using
+the layer names built by conv_block and identity_block. The layers, blocks
+and stages are printed as tables sorted by time, and the op times are written
+in the folded stack format of flamegraph.pl and speedscope:
+
+    python profiler.py --depth 152 --batch-size 8 --output resnet152.folded
+    flamegraph.pl resnet152.folded > resnet152.svg
+
+Run with CUDA_VISIBLE_DEVICES="" to profile on the CPU of a GPU machine. The
+op times of a traced run add up to more than its wall time when TensorFlow
+runs independent ops in parallel, so the shares are shares of the op time.
+
+"""
+import re
+import timeit as t
+from collections import OrderedDict
+
+import numpy as np
+
+_BLOCK_NAME = re.compile(r"^(?:res|bn|scale)([2-5])([a-z]\d*)(?:_|$)")
+_HEAD_LAYERS = ("avg_pool", "fc1000", "flatten")
+_OTHER = "other"
+
+
+def layer_group(name):
+    """ (stage, block) a layer belongs to, e.g. ("res4", "res4b12") or ("stem", "stem")
+    """
+    match = _BLOCK_NAME.match(name)
+    if match:
+        stage, block = match.groups()
+        return "res" + stage, "res" + stage + block
+    if name.startswith(_HEAD_LAYERS):
+        return "head", "head"
+    if name.startswith(("conv1", "bn_conv1", "scale_conv1", "pool1")):
+        return "stem", "stem"
+    return _OTHER, _OTHER
+
+
+def _elements(shape):
+    return int(np.prod([dim for dim in shape[1:]]))
+
+
+def layer_costs(model, batch_size=1):
+    """ FLOPs and output activation bytes of every layer for a batch
+
+    Returns an OrderedDict of layer names, in the order of the model, to dicts
+    with "flops" and "activation_bytes".
+    """
+    import keras.backend as K
+
+    channel_axis = -1 if K.image_data_format() == "channels_last" else 1
+    bytes_per_element = np.dtype(K.floatx()).itemsize
+    costs = OrderedDict()
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == "InputLayer":
+            continue
+        outputs = _elements(layer.output_shape)
+        if kind == "Conv2D":
+            kernel_height, kernel_width = layer.kernel_size
+            multiply_adds = outputs * kernel_height * kernel_width * layer.input_shape[channel_axis]
+            flops = 2 * multiply_adds + (outputs if layer.use_bias else 0)
+        elif kind == "Dense":
+            flops = 2 * _elements(layer.input_shape) * layer.units + layer.units
+        elif kind in ("BatchNormalization", "Scale"):
+            # One multiplication and one addition per element at inference
+            flops = 2 * outputs
+        elif kind == "Activation":
+            flops = outputs
+        elif kind == "Add":
+            flops = (len(layer.input_shape) - 1) * outputs
+        elif kind in ("MaxPooling2D", "AveragePooling2D"):
+            flops = outputs * int(np.prod(layer.pool_size))
+        else:
+            flops = 0
+        costs[layer.name] = {
+            "flops": flops * batch_size,
+            "activation_bytes": outputs * batch_size * bytes_per_element,
+        }
+    return costs
+
+
+def _layer_of(node_name, layer_names):
+    """ Layer whose name scope an op belongs to, or _OTHER
+    """
+    scope = node_name.split("/")[0].split(":")[0]
+    if scope in layer_names:
+        return scope
+    # Name scopes of layers called again get a numeric suffix
+    scope = re.sub(r"_\d+$", "", scope)
+    return scope if scope in layer_names else _OTHER
+
+
+def layer_times(model, batch, repeats=5, warmup=2):
+    """ Mean seconds spent in the ops of every layer over traced runs
+
+    Returns the dict of layer names to seconds and the best wall time of an
+    untraced run in seconds.
+    """
+    import keras.backend as K
+    import tensorflow as tf
+
+    session = K.get_session()
+    feed_dict = {model.input: batch}
+    if not isinstance(K.learning_phase(), int):
+        feed_dict[K.learning_phase()] = 0
+    for _ in range(warmup):
+        session.run(model.outputs, feed_dict)
+    wall = min(t.repeat(lambda: session.run(model.outputs, feed_dict), repeat=repeats, number=1))
+
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    layer_names = set(layer.name for layer in model.layers)
+    times = {}
+    for _ in range(repeats):
+        run_metadata = tf.RunMetadata()
+        session.run(model.outputs, feed_dict, options=options, run_metadata=run_metadata)
+        for device in run_metadata.step_stats.dev_stats:
+            # GPU traces repeat the kernels of the compute streams
+            if "stream" in device.device or "memcpy" in device.device:
+                continue
+            for node in device.node_stats:
+                layer = _layer_of(node.node_name, layer_names)
+                times[layer] = times.get(layer, 0.0) + node.all_end_rel_micros / 1e6
+    return {layer: seconds / repeats for layer, seconds in times.items()}, wall
+
+
+def profile(model, batch_size=1, repeats=5, warmup=2):
+    """ One row per layer with its stage, block, seconds, flops and activation_bytes
+
+    Also returns the best wall time of an untraced forward pass in seconds.
+    """
+    rng = np.random.RandomState(0)
+    batch = rng.uniform(-128, 128, size=(batch_size,) + model.input_shape[1:]).astype(np.float32)
+    times, wall = layer_times(model, batch, repeats, warmup)
+    rows = []
+    for name, cost in layer_costs(model, batch_size).items():
+        stage, block = layer_group(name)
+        rows.append(dict(cost, name=name, stage=stage, block=block, seconds=times.get(name, 0.0)))
+    if times.get(_OTHER):
+        rows.append(
+            {
+                "name": _OTHER,
+                "stage": _OTHER,
+                "block": _OTHER,
+                "seconds": times[_OTHER],
+                "flops": 0,
+                "activation_bytes": 0,
+            }
+        )
+    return rows, wall
+
+
+def aggregate(rows, key):
+    """ Rows summed per value of key ("block" or "stage"), in order of appearance
+    """
+    totals = OrderedDict()
+    for row in rows:
+        total = totals.setdefault(
+            row[key],
+            {"name": row[key], "stage": row["stage"], "seconds": 0.0, "flops": 0, "activation_bytes": 0},
+        )
+        for field in ("seconds", "flops", "activation_bytes"):
+            total[field] += row[field]
+    return list(totals.values())
+
+
+def format_table(rows, title, top=None):
+    """ The rows sorted by time as a text table, only the top ones if given
+    """
+    total_seconds = sum(row["seconds"] for row in rows) or 1.0
+    lines = [
+        "{0:<24} {1:>10} {2:>7} {3:>9} {4:>9} {5:>11}".format(
+            title, "time ms", "share", "GFLOP", "GFLOP/s", "act. MB"
+        )
+    ]
+    for row in sorted(rows, key=lambda row: row["seconds"], reverse=True)[:top]:
+        lines.append(
+            "{0:<24} {1:10.3f} {2:7.1%} {3:9.3f} {4:9.1f} {5:11.2f}".format(
+                row["name"],
+                row["seconds"] * 1000,
+                row["seconds"] / total_seconds,
+                row["flops"] / 1e9,
+                row["flops"] / 1e9 / row["seconds"] if row["seconds"] else 0.0,
+                row["activation_bytes"] / 2 ** 20,
+            )
+        )
+    return "\n".join(lines)
+
+
+def write_folded(path, rows, root):
+    """ Write the op time of every layer in microseconds as model;stage;block;layer stacks
+    """
+    with open(path, "w") as f:
+        for row in rows:
+            micros = int(round(row["seconds"] * 1e6))
+            if not micros:
+                continue
+            frames = [root, row["stage"]]
+            if row["block"] != row["stage"]:
+                frames.append(row["block"])
+            if row["name"] != row["block"]:
+                frames.append(row["name"])
+            f.write("{} {}\n".format(";".join(frames), micros))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--depth", type=int, choices=(50, 101, 152), default=152)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--fused", action="store_true",
+                        help="profile the graph with BatchNormalization and Scale folded into the convolutions")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20, help="number of layers and blocks listed")
+    parser.add_argument("--output", default="resnet_profile.folded", help="folded stacks for flamegraph.pl")
+    args = parser.parse_args()
+
+    import keras.backend as K
+    from resnet152 import ResNet
+
+    K.set_learning_phase(0)
+    model = ResNet(args.depth, weights=None, fused=args.fused)
+    rows, wall = profile(model, args.batch_size, args.repeats)
+    op_seconds = sum(row["seconds"] for row in rows)
+    print(
+        "{}, batch size {}: {:.1f} ms wall time, {:.1f} ms op time, {:.2f} GFLOP\n".format(
+            model.name,
+            args.batch_size,
+            wall * 1000,
+            op_seconds * 1000,
+            sum(row["flops"] for row in rows) / 1e9,
+        )
+    )
+    print(format_table(aggregate(rows, "stage"), "stage"))
+    print()
+    print(format_table(aggregate(rows, "block"), "block", args.top))
+    print()
+    print(format_table(rows, "layer", args.top))
+    write_folded(args.output, rows, model.name)
+    print("\nFolded stacks written to", args.output)
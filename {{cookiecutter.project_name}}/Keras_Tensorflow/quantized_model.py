@@ -0,0 +1,276 @@
+"""Int8 inference of ResNet152 with TensorFlow Lite for CPU only devices.
+
+On the CPUs of IoT Edge devices the float32 forward pass is the main cost of
+scoring an image. export_quantized converts the fused ResNet to a TensorFlow
+Lite model with full integer post-training quantization:
+
+- the convolution and dense kernels are stored as int8 with one scale per
+  output channel,
+- the activations are int8 too, their ranges are calibrated on local images,
+- the input and output stay float32, so the model takes the batches of
+  BatchPreprocessor and returns probabilities like the Keras model.
+
+TensorFlow Lite then computes the convolutions with its int8 kernels instead
+of float32 ones, and the file is about four times smaller. Quantization changes
+the predictions, so export_quantized calibrates on every other image and
+refuses to write the model if its predictions agree too rarely with those of
+the float32 model on the remaining images.
+
+The driver loads a model written by export_quantized through the same
+get_model_api() as any other model path, see QuantizedModel.
+
+    python quantized_model.py export --weights model_resnet_weights.h5 --images images/ \\
+        --output model_resnet152_int8.tflite --min-top1 0.99 --min-top3 0.95
+
+Compare the latency of the int8 and float32 models, with random weights and a
+model calibrated on random images if no files are given:
+
+    python quantized_model.py benchmark [--weights model_resnet_weights.h5 --model model_resnet152_int8.tflite]
+
+"""
+import os
+import threading
+import timeit as t
+
+import numpy as np
+
+# Identifier of TensorFlow Lite flatbuffers, after the offset of the root table
+_TFLITE_IDENTIFIER = b"TFL3"
+
+
+def is_quantized_model(path):
+    """ True if path is a TensorFlow Lite model, e.g. one written by export_quantized
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(8)[4:] == _TFLITE_IDENTIFIER
+    except OSError:
+        return False
+
+
+class QuantizedModel(object):
+    """ TensorFlow Lite model with the predict() of a Keras model
+
+    The interpreter is resized whenever the batch size changes, which is cheap
+    compared to scoring the batch. Calls of predict are serialised, as the
+    interpreter is not thread safe.
+
+    Keyword arguments:
+    path -- TensorFlow Lite model written by export_quantized
+
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self._interpreter = tf.lite.Interpreter(model_path=path)
+        input_details = self._interpreter.get_input_details()[0]
+        self._input_index = input_details["index"]
+        self._output_index = self._interpreter.get_output_details()[0]["index"]
+        self.input_shape = (None,) + tuple(int(size) for size in input_details["shape"][1:])
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, batch, batch_size=None):
+        """ Probabilities of the classes of every image of a preprocessed float32 batch
+        """
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input_index, list(batch.shape))
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self._interpreter.set_tensor(self._input_index, batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output_index)
+
+
+def _preprocessed_images(image_paths, batch_size=8):
+    """ Yield the preprocessed images one at a time, as batches of one
+    """
+    from preprocessing import BatchPreprocessor
+
+    preprocess = BatchPreprocessor()
+    for start in range(0, len(image_paths), batch_size):
+        batch = preprocess(image_paths[start : start + batch_size])
+        for image in batch:
+            # The preprocessor reuses its buffers for the next batch
+            yield np.array(image[None])
+
+
+def convert(model, calibration_images):
+    """ TensorFlow Lite flatbuffer of a ResNet with int8 weights and activations
+
+    Keyword arguments:
+    model -- the float32 ResNet, fused or not
+    calibration_images -- function returning an iterable of preprocessed
+        images of shape (1, height, width, 3) to calibrate the activation
+        ranges on
+
+    """
+    import keras.backend as K
+    import tensorflow as tf
+    from resnet152 import fuse_for_inference
+
+    model = fuse_for_inference(model)
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), model.inputs, model.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(
+        lambda: ([image] for image in calibration_images())
+    )
+    return converter.convert()
+
+
+def compare_precision(model, quantized_model, image_paths, batch_size=8):
+    """ Agreement of the predictions of a quantized model with the float32 model
+
+    Returns:
+    A dict with the fraction of images with the same best class (top1), with
+    the same three best classes in the same order (top3), the number of images
+    and the maximum absolute difference between the scores.
+    """
+    from preprocessing import BatchPreprocessor
+    from response_format import top_k
+
+    preprocess = BatchPreprocessor()
+    top1 = top3 = 0
+    max_abs_diff = 0.0
+    for start in range(0, len(image_paths), batch_size):
+        batch = preprocess(image_paths[start : start + batch_size])
+        preds = model.predict(batch)
+        quantized_preds = quantized_model.predict(batch)
+        indices, _ = top_k(preds, 3)
+        quantized_indices, _ = top_k(quantized_preds, 3)
+        top1 += int(np.sum(indices[:, 0] == quantized_indices[:, 0]))
+        top3 += int(np.sum(np.all(indices == quantized_indices, axis=1)))
+        max_abs_diff = max(max_abs_diff, float(np.max(np.abs(preds - quantized_preds))))
+    num_images = max(len(image_paths), 1)
+    return {
+        "top1": top1 / num_images,
+        "top3": top3 / num_images,
+        "images": len(image_paths),
+        "max_abs_diff": max_abs_diff,
+    }
+
+
+def export_quantized(model, path, image_paths, min_top1=0.99, min_top3=0.95, batch_size=8):
+    """ Export an int8 model if it agrees enough with the float32 model
+
+    The activation ranges are calibrated on every other image and the
+    agreement is measured on the others, so at least two images are needed.
+
+    Keyword arguments:
+    model -- the float32 ResNet, fused or not
+    path -- where the TensorFlow Lite model is written
+    image_paths -- local images to calibrate on and to compare the predictions on
+    min_top1 -- minimum fraction of images with the same best class (default 0.99)
+    min_top3 -- minimum fraction of images with the same three best classes
+        (default 0.95)
+
+    Returns:
+    The agreement reported by compare_precision.
+
+    Raises:
+    ValueError: if either agreement is below its minimum, no model is written.
+    """
+    image_paths = list(image_paths)
+    if len(image_paths) < 2:
+        raise ValueError("Quantized models need images to calibrate and to check the accuracy on")
+    calibration_paths, check_paths = image_paths[0::2], image_paths[1::2]
+    content = convert(model, lambda: _preprocessed_images(calibration_paths, batch_size))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    try:
+        agreement = compare_precision(
+            model, QuantizedModel(tmp_path), check_paths, batch_size=batch_size
+        )
+        if agreement["top1"] < min_top1 or agreement["top3"] < min_top3:
+            raise ValueError(
+                "int8 model agrees with float32 on top-1 {:.4f} (minimum {}) and top-3 "
+                "{:.4f} (minimum {}) of {} images, not exporting".format(
+                    agreement["top1"], min_top1, agreement["top3"], min_top3,
+                    agreement["images"],
+                )
+            )
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return agreement
+
+
+def _benchmark(weights_path, model_path, batch_sizes, repeats):
+    import tempfile
+
+    from resnet152 import ResNet152, fuse_for_inference
+
+    model = ResNet152(weights=None)
+    if weights_path is not None:
+        model.load_weights(weights_path)
+    model = fuse_for_inference(model)
+    rng = np.random.RandomState(0)
+    if model_path is None:
+        # Calibrated on noise, which only makes sense for timing
+        content = convert(
+            model,
+            lambda: (rng.normal(0, 50, size=(1, 224, 224, 3)).astype(np.float32) for _ in range(16)),
+        )
+        fd, model_path = tempfile.mkstemp(suffix=".tflite")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+    quantized_model = QuantizedModel(model_path)
+    print("int8 model {:.1f} MB".format(os.path.getsize(model_path) / 2 ** 20))
+    for batch_size in batch_sizes:
+        batch = rng.normal(0, 50, size=(batch_size, 224, 224, 3)).astype(np.float32)
+        for name, scorer in (("float32", model), ("int8", quantized_model)):
+            scorer.predict(batch)
+            best = min(t.repeat(lambda: scorer.predict(batch), repeat=repeats, number=1))
+            print(
+                "batch size {:3d}  {:<8} {:8.1f} ms per batch  {:7.1f} ms per image".format(
+                    batch_size, name, best * 1000, best * 1000 / batch_size
+                )
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="convert HDF5 weights to an int8 model")
+    export_parser.add_argument("--weights", required=True)
+    export_parser.add_argument("--images", required=True,
+                               help="directory of images to calibrate and to check the model on")
+    export_parser.add_argument("--output", default="model_resnet152_int8.tflite")
+    export_parser.add_argument("--min-top1", type=float, default=0.99)
+    export_parser.add_argument("--min-top3", type=float, default=0.95)
+    benchmark_parser = commands.add_parser("benchmark", help="compare the latency to float32")
+    benchmark_parser.add_argument("--weights", help="HDF5 weights of ResNet152")
+    benchmark_parser.add_argument("--model", help="int8 model written by export")
+    benchmark_parser.add_argument("--batch-sizes", default="1,8", help="comma separated batch sizes")
+    benchmark_parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from model_artifact import _image_paths
+        from resnet152 import ResNet152
+
+        model = ResNet152(weights=None)
+        model.load_weights(args.weights)
+        agreement = export_quantized(
+            model, args.output, _image_paths(args.images),
+            min_top1=args.min_top1, min_top3=args.min_top3,
+        )
+        print("Agreement with float32:", json.dumps(agreement))
+        print("Wrote", args.output)
+    elif args.command == "benchmark":
+        _benchmark(
+            args.weights,
+            args.model,
+            [int(batch_size) for batch_size in args.batch_sizes.split(",")],
+            args.repeats,
+        )
+    else:
+        parser.print_help()
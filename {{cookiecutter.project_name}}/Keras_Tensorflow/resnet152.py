@@ -30,10 +30,7 @@ from keras.engine.topology import get_source_inputs
 from keras.utils import layer_utils
 from keras import initializers
 from keras.engine import Layer, InputSpec
-from keras.preprocessing import image
 from keras.utils.data_utils import get_file
-from keras.applications.imagenet_utils import decode_predictions
-from keras.applications.imagenet_utils import preprocess_input
 from keras.applications.imagenet_utils import _obtain_input_shape
 
 import sys
@@ -42,6 +39,11 @@ sys.setrecursionlimit(3000)
 WEIGHTS_PATH = 'https://github.com/adamcasson/resnet152/releases/download/v0.1/resnet152_weights_tf.h5'
 WEIGHTS_PATH_NO_TOP = 'https://github.com/adamcasson/resnet152/releases/download/v0.1/resnet152_weights_tf_notop.h5'
 
+# Number of blocks in stages 2 to 5 of each supported depth
+STAGE_BLOCKS = {50: (3, 4, 6, 3),
+                101: (3, 4, 23, 3),
+                152: (3, 8, 36, 3)}
+
 class Scale(Layer):
     """Custom Layer for ResNet used for BatchNormalization.
     
@@ -106,15 +108,12 @@ class Scale(Layer):
         base_config = super(Scale, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
-def identity_block(input_tensor, kernel_size, filters, stage, block):
-    """The identity_block is the block that has no conv layer at shortcut
+def _conv_bn_scale(input_tensor, filters, kernel_size, conv_name, bn_name, scale_name,
+                   strides=(1, 1), fused=False):
+    """Conv2D followed by BatchNormalization and Scale
     
-    Keyword arguments
-    input_tensor -- input tensor
-    kernel_size -- defualt 3, the kernel size of middle conv layer at main path
-    filters -- list of integers, the nb_filters of 3 conv layer at main path
-    stage -- integer, current stage label, used for generating layer names
-    block -- 'a','b'..., current block label, used for generating layer names
+    When `fused` is True the BatchNormalization and Scale layers are left out
+    and the convolution gets a bias instead, see `fuse_for_inference`.
     
     """
     eps = 1.1e-5
@@ -124,31 +123,49 @@ def identity_block(input_tensor, kernel_size, filters, stage, block):
     else:
         bn_axis = 1
     
+    if fused:
+        return Conv2D(filters, kernel_size, strides=strides, name=conv_name)(input_tensor)
+    
+    x = Conv2D(filters, kernel_size, strides=strides, name=conv_name, use_bias=False)(input_tensor)
+    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name)(x)
+    x = Scale(axis=bn_axis, name=scale_name)(x)
+    return x
+
+def identity_block(input_tensor, kernel_size, filters, stage, block, fused=False):
+    """The identity_block is the block that has no conv layer at shortcut
+    
+    Keyword arguments
+    input_tensor -- input tensor
+    kernel_size -- defualt 3, the kernel size of middle conv layer at main path
+    filters -- list of integers, the nb_filters of 3 conv layer at main path
+    stage -- integer, current stage label, used for generating layer names
+    block -- 'a','b'..., current block label, used for generating layer names
+    fused -- if True, build the convolutions with the BatchNormalization and
+        Scale layers folded into them (default False)
+    
+    """
     nb_filter1, nb_filter2, nb_filter3 = filters
     conv_name_base = 'res' + str(stage) + block + '_branch'
     bn_name_base = 'bn' + str(stage) + block + '_branch'
     scale_name_base = 'scale' + str(stage) + block + '_branch'
 
-    x = Conv2D(nb_filter1, (1, 1), name=conv_name_base + '2a', use_bias=False)(input_tensor)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2a')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2a')(x)
+    x = _conv_bn_scale(input_tensor, nb_filter1, (1, 1), conv_name_base + '2a',
+                       bn_name_base + '2a', scale_name_base + '2a', fused=fused)
     x = Activation('relu', name=conv_name_base + '2a_relu')(x)
 
     x = ZeroPadding2D((1, 1), name=conv_name_base + '2b_zeropadding')(x)
-    x = Conv2D(nb_filter2, (kernel_size, kernel_size), name=conv_name_base + '2b', use_bias=False)(x)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2b')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2b')(x)
+    x = _conv_bn_scale(x, nb_filter2, (kernel_size, kernel_size), conv_name_base + '2b',
+                       bn_name_base + '2b', scale_name_base + '2b', fused=fused)
     x = Activation('relu', name=conv_name_base + '2b_relu')(x)
 
-    x = Conv2D(nb_filter3, (1, 1), name=conv_name_base + '2c', use_bias=False)(x)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2c')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2c')(x)
+    x = _conv_bn_scale(x, nb_filter3, (1, 1), conv_name_base + '2c',
+                       bn_name_base + '2c', scale_name_base + '2c', fused=fused)
 
     x = add([x, input_tensor], name='res' + str(stage) + block)
     x = Activation('relu', name='res' + str(stage) + block + '_relu')(x)
     return x
 
-def conv_block(input_tensor, kernel_size, filters, stage, block, strides=(2, 2)):
+def conv_block(input_tensor, kernel_size, filters, stage, block, strides=(2, 2), fused=False):
     """conv_block is the block that has a conv layer at shortcut
     
     Keyword arguments:
@@ -157,59 +174,71 @@ def conv_block(input_tensor, kernel_size, filters, stage, block, strides=(2, 2))
     filters -- list of integers, the nb_filters of 3 conv layer at main path
     stage -- integer, current stage label, used for generating layer names
     block -- 'a','b'..., current block label, used for generating layer names
+    fused -- if True, build the convolutions with the BatchNormalization and
+        Scale layers folded into them (default False)
         
     Note that from stage 3, the first conv layer at main path is with subsample=(2,2)
     And the shortcut should have subsample=(2,2) as well
     
     """
-    eps = 1.1e-5
-    
-    if K.image_dim_ordering() == 'tf':
-        bn_axis = 3
-    else:
-        bn_axis = 1
-    
     nb_filter1, nb_filter2, nb_filter3 = filters
     conv_name_base = 'res' + str(stage) + block + '_branch'
     bn_name_base = 'bn' + str(stage) + block + '_branch'
     scale_name_base = 'scale' + str(stage) + block + '_branch'
 
-    x = Conv2D(nb_filter1, (1, 1), strides=strides, name=conv_name_base + '2a', use_bias=False)(input_tensor)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2a')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2a')(x)
+    x = _conv_bn_scale(input_tensor, nb_filter1, (1, 1), conv_name_base + '2a',
+                       bn_name_base + '2a', scale_name_base + '2a', strides=strides, fused=fused)
     x = Activation('relu', name=conv_name_base + '2a_relu')(x)
 
     x = ZeroPadding2D((1, 1), name=conv_name_base + '2b_zeropadding')(x)
-    x = Conv2D(nb_filter2, (kernel_size, kernel_size),
-                      name=conv_name_base + '2b', use_bias=False)(x)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2b')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2b')(x)
+    x = _conv_bn_scale(x, nb_filter2, (kernel_size, kernel_size), conv_name_base + '2b',
+                       bn_name_base + '2b', scale_name_base + '2b', fused=fused)
     x = Activation('relu', name=conv_name_base + '2b_relu')(x)
 
-    x = Conv2D(nb_filter3, (1, 1), name=conv_name_base + '2c', use_bias=False)(x)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '2c')(x)
-    x = Scale(axis=bn_axis, name=scale_name_base + '2c')(x)
+    x = _conv_bn_scale(x, nb_filter3, (1, 1), conv_name_base + '2c',
+                       bn_name_base + '2c', scale_name_base + '2c', fused=fused)
 
-    shortcut = Conv2D(nb_filter3, (1, 1), strides=strides,
-                             name=conv_name_base + '1', use_bias=False)(input_tensor)
-    shortcut = BatchNormalization(epsilon=eps, axis=bn_axis, name=bn_name_base + '1')(shortcut)
-    shortcut = Scale(axis=bn_axis, name=scale_name_base + '1')(shortcut)
+    shortcut = _conv_bn_scale(input_tensor, nb_filter3, (1, 1), conv_name_base + '1',
+                              bn_name_base + '1', scale_name_base + '1', strides=strides, fused=fused)
 
     x = add([x, shortcut], name='res' + str(stage) + block)
     x = Activation('relu', name='res' + str(stage) + block + '_relu')(x)
     return x
 
+def _block_names(depth, stage, num_blocks):
+    """Block labels of a stage.
+
+    For ResNet50 and ResNet152 these are the layer names of the original Caffe
+    models, which the pretrained weights are stored under. ResNet101 uses the
+    ResNet152 scheme, so its names are not guaranteed to match its Caffe model.
+    """
+    if depth == 50 or stage in (2, 5):
+        return [chr(ord('a') + i) for i in range(num_blocks)]
+    return ['a'] + ['b' + str(i) for i in range(1, num_blocks)]
+
 def ResNet152(include_top=True, weights=None,
               input_tensor=None, input_shape=None,
               large_input=False, pooling=None,
-              classes=1000):
-    """Instantiate the ResNet152 architecture.
+              classes=1000, fused=False):
+    """Instantiate the ResNet152 architecture, see `ResNet` for the arguments."""
+    return ResNet(152, include_top=include_top, weights=weights,
+                  input_tensor=input_tensor, input_shape=input_shape,
+                  large_input=large_input, pooling=pooling,
+                  classes=classes, fused=fused)
+
+def ResNet(depth=152, include_top=True, weights=None,
+           input_tensor=None, input_shape=None,
+           large_input=False, pooling=None,
+           classes=1000, fused=False):
+    """Instantiate the ResNet50, ResNet101 or ResNet152 architecture.
     
     Keyword arguments:
+    depth -- number of layers, one of the keys of `STAGE_BLOCKS`. (default 152)
     include_top -- whether to include the fully-connected layer at the 
         top of the network. (default True)
     weights -- one of `None` (random initialization) or "imagenet" 
-        (pre-training on ImageNet). (default None)
+        (pre-training on ImageNet, only available for a depth of 152).
+        (default None)
     input_tensor -- optional Keras tensor (i.e. output of `layers.Input()`)
         to use as image input for the model.(default None)
     input_shape -- optional shape tuple, only to be specified if 
@@ -234,24 +263,38 @@ def ResNet152(include_top=True, weights=None,
     classes -- optional number of classes to classify image into, only 
         to be specified if `include_top` is True, and if no `weights` 
         argument is specified. (default 1000)
+    fused -- if True, build the inference graph in which every 
+        BatchNormalization and Scale layer is folded into the preceding 
+        convolution. Weights of a trained model are converted with 
+        `fuse_for_inference`. (default False)
             
     Returns:
     A Keras model instance.
         
     Raises:
-    ValueError: in case of invalid argument for `weights`,
+    ValueError: in case of invalid argument for `depth` or `weights`,
         or invalid input shape.
     """
+    if depth not in STAGE_BLOCKS:
+        raise ValueError('The `depth` argument should be one of {}'.format(sorted(STAGE_BLOCKS)))
+
     if weights not in {'imagenet', None}:
         raise ValueError('The `weights` argument should be either '
                          '`None` (random initialization) or `imagenet` '
                          '(pre-training on ImageNet).')
 
+    if weights == 'imagenet' and depth != 152:
+        raise ValueError('Pretrained imagenet weights are only available for ResNet152')
+
     if weights == 'imagenet' and include_top and classes != 1000:
         raise ValueError('If using `weights` as imagenet with `include_top`'
                          ' as true, `classes` should be 1000')
-    
-    eps = 1.1e-5
+    if weights == 'imagenet' and fused:
+        # The pretrained weights are stored for the unfused graph
+        return fuse_for_inference(ResNet(depth, include_top=include_top, weights=weights,
+                                         input_shape=input_shape, large_input=large_input,
+                                         pooling=pooling, classes=classes),
+                                  input_tensor=input_tensor)
     
     if large_input:
         img_size = 448
@@ -273,34 +316,20 @@ def ResNet152(include_top=True, weights=None,
         else:
             img_input = input_tensor
 
-    # handle dimension ordering for different backends
-    if K.image_dim_ordering() == 'tf':
-        bn_axis = 3
-    else:
-        bn_axis = 1
-            
     x = ZeroPadding2D((3, 3), name='conv1_zeropadding')(img_input)
-    x = Conv2D(64, (7, 7), strides=(2, 2), name='conv1', use_bias=False)(x)
-    x = BatchNormalization(epsilon=eps, axis=bn_axis, name='bn_conv1')(x)
-    x = Scale(axis=bn_axis, name='scale_conv1')(x)
+    x = _conv_bn_scale(x, 64, (7, 7), 'conv1', 'bn_conv1', 'scale_conv1',
+                       strides=(2, 2), fused=fused)
     x = Activation('relu', name='conv1_relu')(x)
     x = MaxPooling2D((3, 3), strides=(2, 2), name='pool1')(x)
 
-    x = conv_block(x, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1))
-    x = identity_block(x, 3, [64, 64, 256], stage=2, block='b')
-    x = identity_block(x, 3, [64, 64, 256], stage=2, block='c')
-
-    x = conv_block(x, 3, [128, 128, 512], stage=3, block='a')
-    for i in range(1,8):
-        x = identity_block(x, 3, [128, 128, 512], stage=3, block='b'+str(i))
-
-    x = conv_block(x, 3, [256, 256, 1024], stage=4, block='a')
-    for i in range(1,36):
-        x = identity_block(x, 3, [256, 256, 1024], stage=4, block='b'+str(i))
-
-    x = conv_block(x, 3, [512, 512, 2048], stage=5, block='a')
-    x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
-    x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
+    for stage, num_blocks in zip(range(2, 6), STAGE_BLOCKS[depth]):
+        filters = [64 * 2 ** (stage - 2), 64 * 2 ** (stage - 2), 256 * 2 ** (stage - 2)]
+        blocks = _block_names(depth, stage, num_blocks)
+        # Stage 2 follows the max pooling and keeps the resolution
+        strides = (1, 1) if stage == 2 else (2, 2)
+        x = conv_block(x, 3, filters, stage=stage, block=blocks[0], strides=strides, fused=fused)
+        for block in blocks[1:]:
+            x = identity_block(x, 3, filters, stage=stage, block=block, fused=fused)
 
     if large_input:
         x = AveragePooling2D((14, 14), name='avg_pool')(x)
@@ -324,7 +353,7 @@ def ResNet152(include_top=True, weights=None,
     else:
         inputs = img_input
     # Create model.
-    model = Model(inputs, x, name='resnet152')
+    model = Model(inputs, x, name='resnet' + str(depth))
     
     # load weights
     if weights == 'imagenet':
@@ -358,7 +387,160 @@ def ResNet152(include_top=True, weights=None,
                           'at ~/.keras/keras.json.')
     return model
 
+def _bn_scale_names(conv_name):
+    """Names of the BatchNormalization and Scale layers following a Conv2D"""
+    if conv_name.startswith('res'):
+        suffix = conv_name[len('res'):]
+        return 'bn' + suffix, 'scale' + suffix
+    return 'bn_' + conv_name, 'scale_' + conv_name
+
+def resnet152_config(model):
+    """Keyword arguments of `ResNet` that rebuild the architecture of a model.
+    
+    Keyword arguments:
+    model -- a model created with `ResNet` or `ResNet152`
+    
+    Returns:
+    A dict with the `depth`, `include_top`, `input_shape`, `large_input`,
+    `pooling`, `classes` and `fused` arguments.
+    """
+    layer_names = set(layer.name for layer in model.layers)
+    # The depths differ in the number of blocks of stage 4, which end in an add layer named res4<block>
+    stage4_blocks = sum(1 for name in layer_names if name.startswith('res4') and '_' not in name)
+    depth = [d for d, blocks in STAGE_BLOCKS.items() if blocks[2] == stage4_blocks][0]
+    include_top = 'fc1000' in layer_names
+    last_layer = model.layers[-1]
+    if isinstance(last_layer, GlobalAveragePooling2D):
+        pooling = 'avg'
+    elif isinstance(last_layer, GlobalMaxPooling2D):
+        pooling = 'max'
+    else:
+        pooling = None
+    return {'depth': depth,
+            'include_top': include_top,
+            'input_shape': tuple(model.input_shape[1:]),
+            'large_input': model.get_layer('avg_pool').pool_size[0] == 14,
+            'pooling': pooling,
+            'classes': model.get_layer('fc1000').units if include_top else 1000,
+            'fused': 'bn_conv1' not in layer_names}
+
+def fuse_for_inference(model, input_tensor=None):
+    """Fold the BatchNormalization and Scale layers of a ResNet into its convolutions.
+    
+    At inference time BatchNormalization followed by Scale is the per channel
+    affine transform
+    
+        out = (in - mean) / sqrt(var + eps) * bn_gamma * gamma + bn_beta * gamma + beta,
+    
+    so it can be folded into the kernel and bias of the preceding Conv2D. The
+    returned model computes the same outputs as `model` with two fewer layers
+    per convolution.
+    
+    Keyword arguments:
+    model -- a model created with `ResNet` or `ResNet152` with its weights loaded
+    input_tensor -- optional Keras tensor to use as the input of the fused
+        model. (default None)
+    
+    Returns:
+    A new Keras model instance built with `ResNet(..., fused=True)`, or
+    `model` itself if it is already fused.
+    """
+    config = resnet152_config(model)
+    if config['fused']:
+        return model
+    config['fused'] = True
+    fused_model = ResNet(weights=None, input_tensor=input_tensor, **config)
+
+    for layer in fused_model.layers:
+        if not layer.weights:
+            continue
+        source_weights = model.get_layer(layer.name).get_weights()
+        if not isinstance(layer, Conv2D):
+            layer.set_weights(source_weights)
+            continue
+        kernel = source_weights[0]
+        bn_name, scale_name = _bn_scale_names(layer.name)
+        bn_layer = model.get_layer(bn_name)
+        bn_gamma, bn_beta, moving_mean, moving_variance = bn_layer.get_weights()
+        gamma, beta = model.get_layer(scale_name).get_weights()
+        std = np.sqrt(moving_variance + bn_layer.epsilon)
+        channel_scale = gamma * bn_gamma / std
+        bias = gamma * (bn_beta - bn_gamma * moving_mean / std) + beta
+        # The output channels are the last axis of the kernel for both data formats
+        layer.set_weights([(kernel * channel_scale).astype(kernel.dtype),
+                           bias.astype(kernel.dtype)])
+    return fused_model
+
+def compare_fused(model, fused_model, batch_size=8, repeats=5, atol=1e-4):
+    """Check that a fused model reproduces the outputs of the original and time both.
+    
+    Keyword arguments:
+    model -- the unfused ResNet152
+    fused_model -- the result of `fuse_for_inference(model)`
+    batch_size -- number of random images scored per call (default 8)
+    repeats -- number of timed calls, the best one is reported (default 5)
+    atol -- maximum allowed absolute difference between the outputs (default 1e-4)
+    
+    Returns:
+    A dict with the maximum absolute difference between the outputs and the
+    best latency of each model in ms.
+    
+    Raises:
+    AssertionError: if the outputs differ by more than `atol`.
+    """
+    import timeit
+    from keras.applications.imagenet_utils import preprocess_input
+    
+    x = np.random.uniform(0, 255, size=(batch_size,) + model.input_shape[1:]).astype(np.float32)
+    x = preprocess_input(x)
+    preds = model.predict(x, batch_size=batch_size)
+    fused_preds = fused_model.predict(x, batch_size=batch_size)
+    max_abs_diff = float(np.max(np.abs(preds - fused_preds)))
+    assert max_abs_diff <= atol, 'Fused model differs by {} > {}'.format(max_abs_diff, atol)
+
+    def best_latency(m):
+        timer = timeit.Timer(lambda: m.predict(x, batch_size=batch_size))
+        return round(min(timer.repeat(repeat=repeats, number=1)) * 1000, 2)
+
+    return {'max_abs_diff': max_abs_diff,
+            'layers': len(model.layers),
+            'fused_layers': len(fused_model.layers),
+            'latency_ms': best_latency(model),
+            'fused_latency_ms': best_latency(fused_model)}
+
 if __name__ == '__main__':
+    import argparse
+    from keras.applications.imagenet_utils import decode_predictions
+    from keras.applications.imagenet_utils import preprocess_input
+    from keras.preprocessing import image
+
+    parser = argparse.ArgumentParser(description='Score elephant.jpg with ResNet152')
+    parser.add_argument('--compare-fused', action='store_true',
+                        help='check the parity and latency of the fused model instead. '
+                             'Run with CUDA_VISIBLE_DEVICES="" to compare on CPU')
+    parser.add_argument('--random-weights', action='store_true',
+                        help='use random weights and normalization statistics '
+                             'instead of downloading the imagenet weights')
+    args = parser.parse_args()
+
+    if args.compare_fused:
+        model = ResNet152(include_top=True, weights=None if args.random_weights else 'imagenet')
+        if args.random_weights:
+            # Default statistics make BatchNormalization and Scale the identity
+            for layer in model.layers:
+                if isinstance(layer, BatchNormalization):
+                    gamma, beta, mean, variance = layer.get_weights()
+                    layer.set_weights([np.random.uniform(0.5, 1.5, gamma.shape),
+                                       np.random.normal(0, 0.1, beta.shape),
+                                       np.random.normal(0, 0.1, mean.shape),
+                                       np.random.uniform(0.5, 1.5, variance.shape)])
+                elif isinstance(layer, Scale):
+                    gamma, beta = layer.get_weights()
+                    layer.set_weights([np.random.uniform(0.5, 1.5, gamma.shape),
+                                       np.random.normal(0, 0.1, beta.shape)])
+        print(compare_fused(model, fuse_for_inference(model)))
+        sys.exit(0)
+
     model = ResNet152(include_top=True, weights='imagenet')
     
     img_path = 'elephant.jpg'
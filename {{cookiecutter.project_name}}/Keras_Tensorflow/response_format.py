@@ -0,0 +1,192 @@
+"""Top-k post-processing and response encodings for the model driver.
+
+keras' decode_predictions sorts all 1000 scores of every image and looks up
+the labels of the best ones, and the driver used to cast the whole prediction
+matrix to float64 first so that the scores could be serialized to JSON. The
+driver now selects the top k classes of the whole batch at once with a partial
+selection on the float32 predictions and only keeps their indices and scores.
+Those are turned into the usual JSON response with a label table that is built
+once, or, for clients that send
+
+    Accept: application/vnd.resnet.topk; scores=float16
+
+into a compact binary response (scores=float32 is accepted as well):
+
+    magic (4 bytes) | version (uint8) | score size in bytes (uint8) | k (uint16)
+    | number of images (uint32) | per image: key length (uint16), UTF-8 key
+    | class indices (uint16, images x k) | scores (float16 or float32, images x k)
+
+All numbers are little endian. Clients fetch the label table of the class
+indices once with GET /score?format=labels.
+
+Run this module directly to compare the serialization cost and response size:
+
+    python response_format.py --images 8 --top 3
+
+"""
+import json
+import struct
+
+import numpy as np
+
+BINARY_CONTENT_TYPE = "application/vnd.resnet.topk"
+_MAGIC = b"TOPK"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBBHI")
+_KEY_LENGTH = struct.Struct("<H")
+_SCORE_DTYPES = {"float16": np.dtype("<f2"), "float32": np.dtype("<f4")}
+
+
+def top_k(preds, k):
+    """ Indices and scores of the k best classes of every row, best first
+
+    Only the k best scores of each row are sorted, the rest are merely
+    partitioned away from them.
+    """
+    preds = np.asarray(preds)
+    k = min(k, preds.shape[1])
+    rows = np.arange(len(preds))[:, None]
+    indices = np.argpartition(preds, preds.shape[1] - k, axis=1)[:, -k:]
+    order = np.argsort(preds[rows, indices], axis=1)[:, ::-1]
+    indices = indices[rows, order]
+    return indices, preds[rows, indices]
+
+
+def top_k_lists(preds, k):
+    """ top_k as one JSON serializable list of [index, score] pairs per image
+    """
+    indices, scores = top_k(preds, k)
+    return [
+        [list(pair) for pair in zip(row_indices, row_scores)]
+        for row_indices, row_scores in zip(indices.tolist(), scores.tolist())
+    ]
+
+
+def imagenet_labels():
+    """ (wordnet id, name) of every imagenet class, in class index order
+    """
+    from keras.applications.imagenet_utils import decode_predictions
+
+    # The best class of every row of the identity matrix is the row index
+    return [tuple(row[0][:2]) for row in decode_predictions(np.eye(1000), top=1)]
+
+
+def to_json(image_top_k, labels):
+    """ [index, score] pairs in the (wordnet id, name, score) format of decode_predictions
+    """
+    return [labels[index] + (score,) for index, score in image_top_k]
+
+
+def binary_score_dtype(accept):
+    """ Name of the score type if the Accept header asks for the binary format, else None
+    """
+    for media_range in (accept or "").split(","):
+        parts = [part.strip() for part in media_range.split(";")]
+        if parts[0].lower() != BINARY_CONTENT_TYPE:
+            continue
+        params = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+        scores = params.get("scores", "float16").strip('"').lower()
+        if scores in _SCORE_DTYPES:
+            return scores
+    return None
+
+
+def encode_binary(preds, score_dtype="float16"):
+    """ Encode a dict of image keys to [index, score] pairs, see the module docstring
+    """
+    dtype = _SCORE_DTYPES[score_dtype]
+    keys = list(preds)
+    k = len(preds[keys[0]]) if keys else 0
+    pairs = np.array([preds[key] for key in keys], dtype=np.float64).reshape(len(keys), k, 2)
+    chunks = [_HEADER.pack(_MAGIC, _VERSION, dtype.itemsize, k, len(keys))]
+    for key in keys:
+        encoded_key = str(key).encode("utf-8")
+        chunks.append(_KEY_LENGTH.pack(len(encoded_key)))
+        chunks.append(encoded_key)
+    chunks.append(pairs[..., 0].astype("<u2").tobytes())
+    chunks.append(pairs[..., 1].astype(dtype).tobytes())
+    return b"".join(chunks)
+
+
+def decode_binary(data):
+    """ Decode a binary response into a dict of image keys to (index, score) pairs
+    """
+    magic, version, score_size, k, num_images = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a version {} top-k response".format(_VERSION))
+    offset = _HEADER.size
+    keys = []
+    for _ in range(num_images):
+        (length,) = _KEY_LENGTH.unpack_from(data, offset)
+        offset += _KEY_LENGTH.size
+        keys.append(data[offset : offset + length].decode("utf-8"))
+        offset += length
+    indices = np.frombuffer(data, dtype="<u2", count=num_images * k, offset=offset)
+    offset += indices.nbytes
+    scores = np.frombuffer(
+        data, dtype="<f{}".format(score_size), count=num_images * k, offset=offset
+    )
+    indices = indices.reshape(num_images, k).tolist()
+    scores = scores.reshape(num_images, k).astype(np.float32).tolist()
+    return {
+        key: list(zip(row_indices, row_scores))
+        for key, row_indices, row_scores in zip(keys, indices, scores)
+    }
+
+
+def _reference_decode(preds, labels, top):
+    """ What the driver did before: float64 cast and a full sort of every row
+    """
+    preds = preds.astype(np.float64)
+    results = []
+    for pred in preds:
+        top_indices = pred.argsort()[-top:][::-1]
+        results.append([labels[i] + (pred[i],) for i in top_indices])
+    return results
+
+
+def _benchmark(num_images, top, repeats):
+    import timeit
+
+    rng = np.random.RandomState(0)
+    logits = rng.randn(num_images, 1000).astype(np.float32)
+    preds = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    labels = [("n{:08d}".format(i), "imagenet_class_{}".format(i)) for i in range(1000)]
+    keys = ["image{}".format(i) for i in range(num_images)]
+
+    def reference():
+        return json.dumps(dict(zip(keys, _reference_decode(preds, labels, top))))
+
+    def top_k_json():
+        return json.dumps(
+            {key: to_json(pairs, labels) for key, pairs in zip(keys, top_k_lists(preds, top))}
+        )
+
+    def binary(score_dtype):
+        return lambda: encode_binary(dict(zip(keys, top_k_lists(preds, top))), score_dtype)
+
+    candidates = (
+        ("float64 + sort + JSON", reference),
+        ("top-k + JSON", top_k_json),
+        ("top-k + binary float32", binary("float32")),
+        ("top-k + binary float16", binary("float16")),
+    )
+    for name, func in candidates:
+        body = func()
+        best = min(timeit.repeat(func, repeat=repeats, number=10)) / 10
+        print(
+            "{0:<24} {1:8.1f} us/image  {2:6.1f} bytes/image".format(
+                name, best * 1e6 / num_images, len(body) / num_images
+            )
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--images", type=int, default=8, help="images per response")
+    parser.add_argument("--top", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    _benchmark(args.images, args.top, args.repeats)
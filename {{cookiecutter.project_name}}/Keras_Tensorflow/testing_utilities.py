@@ -1,19 +1,293 @@
+import csv
+import hashlib
+import http.client
+import itertools
 import json
 import logging
+import multiprocessing
+import os
 import random
+import tempfile
+import threading
 import time
-import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import BytesIO
 
-import matplotlib.gridspec as gridspec
-import matplotlib.pyplot as plt
+import numpy as np
 import toolz
 from PIL import Image, ImageOps
-from azureml.core.authentication import AuthenticationException, AzureCliAuthentication, InteractiveLoginAuthentication
+
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+# Errors of a kept alive connection that the server has closed in the meantime
+_STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+
+class ImageFetcher(object):
+    """ Downloads images over kept alive connections and caches their bytes
+
+    http and https URLs are fetched with connections that are pooled per host
+    and their bytes are kept in an in-memory LRU and, optionally, in a
+    directory that outlives the process, so notebooks and benchmarks that are
+    run again do not download the same images again. Other URLs, such as
+    file:// ones, are read with urllib and are not cached.
+
+    Keyword arguments:
+    max_memory_bytes -- size of the in-memory tier (default 64 MB)
+    disk_dir -- optional directory of the on-disk tier (default None)
+    max_disk_bytes -- the least recently used files of the on-disk tier are
+        removed once it is larger than this (default 1 GB)
+    max_idle_connections -- idle connections kept per host (default 8)
+    timeout -- seconds to wait for a server (default 60)
+
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes=64 * 2 ** 20,
+        disk_dir=None,
+        max_disk_bytes=2 ** 30,
+        max_idle_connections=8,
+        timeout=60,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_idle_connections = max_idle_connections
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._idle = {}
+        self._logger = logging.getLogger(__name__)
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self._lock:
+            self._memory_hits = 0
+            self._disk_hits = 0
+            self._downloads = 0
+            self._downloaded_bytes = 0
+            self._connections = 0
+
+    def statistics(self):
+        """ Return the cache and connection counters as a dict
+        """
+        with self._lock:
+            return {
+                "memory_entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "downloads": self._downloads,
+                "downloaded_bytes": self._downloaded_bytes,
+                "connections_opened": self._connections,
+            }
+
+    def clear(self):
+        """ Drop the in-memory tier and close the idle connections
+        """
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _disk_path(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _store_in_memory(self, url, data):
+        if url in self._entries:
+            self._memory_bytes -= len(self._entries.pop(url))
+        self._entries[url] = data
+        self._memory_bytes += len(data)
+        while self._entries and self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _cached(self, url):
+        with self._lock:
+            if url in self._entries:
+                self._entries.move_to_end(url)
+                self._memory_hits += 1
+                return self._entries[url]
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(url)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time orders the files for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._disk_hits += 1
+            self._store_in_memory(url, data)
+        return data
+
+    def _disk_files(self):
+        for directory, _, names in os.walk(self.disk_dir):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, os.path.join(directory, name)
+
+    def _store_on_disk(self, url, data):
+        path = self._disk_path(url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Other processes never read a partially written file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            self._logger.warning("Unable to write image cache file: {}".format(error))
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            # Other processes may share the directory, so it is scanned again
+            files = sorted(self._disk_files())
+            self._disk_bytes = sum(size for _, size, _ in files)
+            for _, size, file_path in files:
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    continue
+                self._disk_bytes -= size
+
+    def _connection(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self._connections += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _get(self, url):
+        """ Status, headers and body of a GET over a pooled connection
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        while True:
+            connection, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path)
+                resp = connection.getresponse()
+                body = resp.read()
+            except _STALE_CONNECTION_ERRORS:
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if resp.will_close:
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            return resp.status, resp.reason, resp.headers, body
+
+    def _download(self, url):
+        for _ in range(10):
+            status, reason, headers, body = self._get(url)
+            if status in _REDIRECTS and headers.get("Location"):
+                url = urllib.parse.urljoin(url, headers["Location"])
+                continue
+            if status != 200:
+                raise urllib.error.HTTPError(url, status, reason, headers, BytesIO(body))
+            return body
+        raise urllib.error.URLError("Too many redirects fetching {}".format(url))
+
+    def fetch(self, url):
+        """ Bytes of the image at url
+        """
+        if urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+            with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+                return resp.read()
+        data = self._cached(url)
+        if data is not None:
+            return data
+        data = self._download(url)
+        with self._lock:
+            self._downloads += 1
+            self._downloaded_bytes += len(data)
+            self._store_in_memory(url, data)
+        if self.disk_dir is not None:
+            self._store_on_disk(url, data)
+        return data
+
+    def fetch_many(self, urls, max_workers=8):
+        """ Bytes of the images at urls, in order, fetched max_workers at a time
+        """
+        urls = list(urls)
+        if len(urls) <= 1 or max_workers <= 1:
+            return [self.fetch(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+            return list(executor.map(self.fetch, urls))
+
+
+_image_fetcher = None
+_image_fetcher_lock = threading.Lock()
+
+
+def get_image_fetcher():
+    """ The ImageFetcher of read_image_from and to_img
+
+    Its on-disk tier is IMAGE_CACHE_DIR, by default a directory in the
+    temporary directory. Set IMAGE_CACHE_DIR to an empty string to only cache
+    in memory.
+    """
+    global _image_fetcher
+    with _image_fetcher_lock:
+        if _image_fetcher is None:
+            disk_dir = os.getenv(
+                "IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "testing_utilities_images")
+            )
+            _image_fetcher = ImageFetcher(
+                disk_dir=disk_dir or None,
+                max_disk_bytes=int(float(os.getenv("IMAGE_CACHE_MB", 1024)) * 2 ** 20),
+            )
+        return _image_fetcher
 
 
 def read_image_from(url):
-    return toolz.pipe(url, urllib.request.urlopen, lambda x: x.read(), BytesIO)
+    return BytesIO(get_image_fetcher().fetch(url))
+
+
+def read_images_from(urls, max_workers=8):
+    """ read_image_from for many URLs, which are fetched concurrently
+    """
+    return [BytesIO(data) for data in get_image_fetcher().fetch_many(urls, max_workers)]
 
 
 def to_rgb(img_bytes):
@@ -36,6 +310,24 @@ def to_img(img_url):
     return toolz.pipe(img_url, read_image_from, to_rgb, resize(new_size=(224, 224)))
 
 
+def to_tensor(img_url):
+    """ Raw tensor upload of the image at img_url and its content type
+
+    The image is cropped and resized by to_img, so the driver scores it without
+    decoding it. Post a single tensor as the request body, which the driver
+    parses faster than multipart/form-data, or several as files with their
+    content type, e.g. with requests:
+
+        data, content_type = to_tensor(url)
+        requests.post(scoring_url, data=data, headers={"Content-Type": content_type})
+        requests.post(scoring_url, files={"image": ("image", data, content_type)})
+    """
+    from preprocessing import tensor_content_type
+
+    array = np.asarray(to_img(img_url), dtype=np.uint8)
+    return array.tobytes(), tensor_content_type(array.shape)
+
+
 def _plot_image(ax, img):
     ax.imshow(to_img(img))
     ax.tick_params(
@@ -71,11 +363,17 @@ def _plot_prediction_bar(ax, r):
 
 
 def plot_predictions(images, classification_results):
+    # matplotlib is only needed for plotting, importing it takes longer than the rest of this module
+    import matplotlib.gridspec as gridspec
+    import matplotlib.pyplot as plt
+
     if len(images) != 3:
         raise Exception("This method is only designed for 3 images")
     gs = gridspec.GridSpec(1, 3)
     fig = plt.figure(figsize=(12, 9))
     gs.update(hspace=0.1, wspace=0.001)
+    # Fetch the images not in the cache yet at the same time
+    read_images_from(images)
 
     for gg, r, img in zip(gs, classification_results, images):
         gg2 = gridspec.GridSpecFromSubplotSpec(4, 10, subplot_spec=gg)
@@ -91,24 +389,105 @@ def write_json_to_file(json_dict, filename, mode="w"):
         outfile.write("\n\n")
 
 
-def gen_variations_of_one_image(IMAGEURL, num):
-    out_images = []
-    img = to_img(IMAGEURL).convert("RGB")
+def _flip_pixel(img, rng):
     # Flip the colours for one-pixel
-    # "Different Image"
-    for i in range(num):
-        diff_img = img.copy()
-        rndm_pixel_x_y = (
-            random.randint(0, diff_img.size[0] - 1),
-            random.randint(0, diff_img.size[1] - 1),
-        )
-        current_color = diff_img.getpixel(rndm_pixel_x_y)
-        diff_img.putpixel(rndm_pixel_x_y, current_color[::-1])
-        out_images.append(to_bytes(diff_img))
-    return out_images
+    y, x = rng.randint(img.shape[0]), rng.randint(img.shape[1])
+    img[y, x] = img[y, x, ::-1]
+
+
+def _shift_brightness(img, rng):
+    # Brighten or darken a band of 16 rows
+    y = rng.randint(img.shape[0] - 16)
+    delta = rng.randint(1, 4) * rng.choice((-1, 1))
+    img[y : y + 16] = np.clip(img[y : y + 16].astype(np.int16) + delta, 0, 255)
+
+
+def _add_noise(img, rng):
+    y, x = rng.randint(img.shape[0] - 8), rng.randint(img.shape[1] - 8)
+    patch = img[y : y + 8, x : x + 8].astype(np.int16)
+    img[y : y + 8, x : x + 8] = np.clip(patch + rng.randint(-2, 3, size=patch.shape), 0, 255)
+
+
+def _roll(img, rng):
+    # Shift one row sideways
+    y = rng.randint(img.shape[0])
+    img[y] = np.roll(img[y], rng.randint(1, 4), axis=0)
+
+
+_MUTATIONS = {
+    "pixel": _flip_pixel,
+    "brightness": _shift_brightness,
+    "noise": _add_noise,
+    "roll": _roll,
+}
+
+
+def _variation_bytes(base, kind, seed):
+    img = base.copy()
+    _MUTATIONS[kind](img, np.random.RandomState(seed))
+    return to_bytes(Image.fromarray(img))
+
+
+_variation_base = None
+
+
+def _init_variation_worker(base):
+    global _variation_base
+    _variation_base = base
+
+
+def _variation_bytes_in_worker(task):
+    return _variation_bytes(_variation_base, *task)
+
+
+def iter_variations_of_one_image(image, num=None, kinds=("pixel",), processes=1, chunk_size=64, seed=None):
+    """ Lazily generate JPEG encoded "different images" from one image
+
+    image is a URL or a PIL image. Each variation applies one of the mutations
+    in kinds ("pixel", "brightness", "noise" or "roll") to a copy of the image
+    array. With num None the generator never ends. With processes > 1 the
+    variations are encoded chunk_size at a time in a process pool while the
+    previous chunk is consumed, so at most two chunks are held in memory.
+    """
+    if any(kind not in _MUTATIONS for kind in kinds):
+        raise ValueError("kinds must be in {}".format(sorted(_MUTATIONS)))
+    if not isinstance(image, Image.Image):
+        image = to_img(image)
+    base = np.asarray(image.convert("RGB"))
+    seeds = random.Random(seed)
+    indices = itertools.count() if num is None else range(num)
+    tasks = ((kinds[i % len(kinds)], seeds.getrandbits(32)) for i in indices)
+
+    if processes <= 1:
+        for kind, variation_seed in tasks:
+            yield _variation_bytes(base, kind, variation_seed)
+        return
+
+    pool = multiprocessing.Pool(processes, initializer=_init_variation_worker, initargs=(base,))
+    try:
+        chunk = list(itertools.islice(tasks, chunk_size))
+        pending = pool.map_async(_variation_bytes_in_worker, chunk) if chunk else None
+        while pending is not None:
+            variations = pending.get()
+            chunk = list(itertools.islice(tasks, chunk_size))
+            pending = pool.map_async(_variation_bytes_in_worker, chunk) if chunk else None
+            for variation in variations:
+                yield variation
+    finally:
+        pool.terminate()
+
+
+def gen_variations_of_one_image(IMAGEURL, num, **kwargs):
+    return list(iter_variations_of_one_image(IMAGEURL, num, **kwargs))
 
 
 def get_auth():
+    from azureml.core.authentication import (
+        AuthenticationException,
+        AzureCliAuthentication,
+        InteractiveLoginAuthentication,
+    )
+
     logger = logging.getLogger(__name__)
     logger.debug("Trying to create Workspace with CLI Authentication")
     try:
@@ -120,27 +499,680 @@ def get_auth():
     return auth
 
 
-def wait_until_ready(endpoint, max_attempts):
-    code = 0
-    attempts = 0
-    while code != 200:
-        attempts += 1
-        if attempts == max_attempts:
-            print("Unable to connect to endpoint, quitting")
-            raise Exception(
-                "Endpoint unavailable in " + str(max_attempts) + " attempts."
-            )
-            break
+def _readiness_state(body):
+    """ The state reported by the GET branch of the driver's run(), None if absent
+    """
+    try:
+        resp = json.loads(body.decode("utf-8"))
+    except ValueError:
+        return None
+    return resp.get("state") if isinstance(resp, dict) else None
+
+
+def wait_until_ready(endpoint, max_attempts, headers=None, initial_wait=1, max_wait=30):
+    """ Wait until the endpoint answers with HTTP 200 and reports that it is warm
+
+    The wait between attempts doubles from initial_wait up to max_wait seconds.
+    Endpoints that do not report a state, such as the root of the container,
+    are ready as soon as they answer with HTTP 200.
+    """
+    wait = initial_wait
+    for attempts in range(1, max_attempts + 1):
+        code, state = 0, None
         try:
-            code = urllib.request.urlopen(endpoint).getcode()
+            resp = urllib.request.urlopen(
+                urllib.request.Request(endpoint, headers=headers or {})
+            )
+            code = resp.getcode()
+            state = _readiness_state(resp.read())
         except Exception as error:
             print(
                 "Exception caught opening endpoint :" + str(endpoint) + " " + str(error)
             )
 
-        if code != 200:
-            print("Endpoint unavailable, waiting")
-            time.sleep(10)
+        if code == 200 and state in (None, "ready"):
+            return "We are all done with code " + str(code)
+        if attempts == max_attempts:
+            break
+        if code == 200:
+            print("Endpoint is {}, waiting {} seconds".format(state, wait))
+        else:
+            print("Endpoint unavailable, waiting {} seconds".format(wait))
+        time.sleep(wait)
+        wait = min(2 * wait, max_wait)
+
+    print("Unable to connect to endpoint, quitting")
+    raise Exception("Endpoint unavailable in " + str(max_attempts) + " attempts.")
+
+
+def _encode_multipart(images):
+    """ multipart/form-data body with one file field per image and its content type
+
+    images is a dict of image names to image bytes, file objects or (bytes,
+    content type) tuples such as those returned by to_tensor.
+    """
+    boundary = "----{}".format(random.getrandbits(64))
+    chunks = []
+    for key, img in images.items():
+        part_type = "application/octet-stream"
+        if isinstance(img, tuple):
+            img, part_type = img
+        data = img if isinstance(img, bytes) else img.read()
+        chunks.append(
+            "--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\n"
+            "Content-Type: {}\r\n\r\n".format(boundary, key, key, part_type).encode("utf-8")
+        )
+        chunks.append(data)
+        chunks.append(b"\r\n")
+    chunks.append("--{}--\r\n".format(boundary).encode("utf-8"))
+    return b"".join(chunks), "multipart/form-data; boundary={}".format(boundary)
+
+
+def iter_streamed_predictions(url, images, headers=None, timeout=60):
+    """ Post images to the streaming mode of the driver and yield results as they arrive
+
+    images is a dict of image names to image bytes, file objects or the
+    (bytes, content type) tuples of to_tensor. Every yielded dict is one line
+    of the response: {"key", "predictions"} per image and finally {"images",
+    "computed_in_ms"}. A request that is shed, past its deadline or has an
+    invalid tensor raises urllib.error.HTTPError with a 503, 504 or 400, only
+    the failure of a later sub-batch yields {"key", "error"} per image.
+    """
+    body, content_type = _encode_multipart(images)
+    headers = dict(headers or {}, Accept="application/x-ndjson")
+    headers["Content-Type"] = content_type
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        # Reading line by line returns each line as soon as its chunk arrives
+        for line in resp:
+            if line.strip():
+                yield json.loads(line.decode("utf-8"))
+
+
+class LatencyHistogram(object):
+    """ Log-linear latency histogram with microsecond resolution
 
-    output_str = "We are all done with code " + str(code)
-    return output_str
+    Every power of two is split into sub_buckets buckets, so recorded values
+    are exact to within 1/sub_buckets of their magnitude.
+    """
+
+    def __init__(self, sub_buckets=128):
+        self._sub_bucket_bits = sub_buckets.bit_length() - 1
+        self._counts = Counter()
+        self.count = 0
+        self.max = 0.0
+        self.min = float("inf")
+        self.total = 0.0
+
+    def record(self, seconds):
+        micros = max(int(seconds * 1e6), 1)
+        shift = max(micros.bit_length() - 1 - self._sub_bucket_bits, 0)
+        self._counts[(shift, micros >> shift)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.min = min(self.min, seconds)
+
+    def percentile(self, percent):
+        """ Latency in seconds below which percent of the recorded values fall
+        """
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for shift, sub_bucket in sorted(self._counts, key=lambda b: b[1] << b[0]):
+            seen += self._counts[(shift, sub_bucket)]
+            if seen >= threshold:
+                # Middle of the bucket
+                return min(((sub_bucket << shift) + (1 << shift) / 2.0) / 1e6, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+# Statuses of overloaded or unavailable replicas, which are retried
+_RETRY_STATUSES = (502, 503, 504)
+_TIMEOUT_HEADER = "X-Request-Timeout-Ms"
+
+
+class ScoringClient(object):
+    """ Posts images to one or more replicas of the scoring service
+
+    Connections to every replica are kept alive in a pooled session. Every
+    request has a deadline, which is sent in the X-Request-Timeout-Ms header
+    too, so that the driver does not score requests the client has given up
+    on. Connection errors and 502, 503 and 504 responses are retried on the
+    next replica after a jittered backoff, or after the Retry-After of a 503
+    if that is longer, as long as the deadline allows. With hedging, a second
+    copy of a request is sent to the next replica if the first has not been
+    answered after the hedge_percentile of the recent latencies, and the
+    first answer is used. A single URL, such as that of an AKS service, is
+    hedged too, the load balancer then picks the pod.
+
+    Keyword arguments:
+    urls -- scoring URL, or list of URLs of replicas that are used in turn
+    headers -- headers sent with every request, e.g. the authorization header.
+        (default None)
+    timeout -- seconds from the start of a request, including its retries, to
+        its deadline. (default 30)
+    max_retries -- retries of a request after its first attempt. (default 2)
+    backoff -- upper bound in seconds of the first backoff, which doubles with
+        every retry. Every sleep is drawn uniformly below the bound. (default 0.05)
+    hedge -- send hedged requests. (default False)
+    hedge_percentile -- percentile of the latencies of the last 1000 answered
+        requests after which a request is hedged. (default 95)
+    min_hedge_samples -- latencies observed before any request is hedged.
+        (default 20)
+    pool_size -- connections kept alive per replica. (default 10)
+
+    """
+
+    def __init__(
+        self,
+        urls,
+        headers=None,
+        timeout=30,
+        max_retries=2,
+        backoff=0.05,
+        hedge=False,
+        hedge_percentile=95,
+        min_hedge_samples=20,
+        pool_size=10,
+    ):
+        import requests
+
+        self.urls = [urls] if isinstance(urls, str) else list(urls)
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=2 * pool_size, thread_name_prefix="scoring")
+        self._lock = threading.Lock()
+        self._next = 0
+        self._latencies = deque(maxlen=1000)
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self._lock:
+            self._requests = 0
+            self._attempts = 0
+            self._retries = 0
+            self._hedged = 0
+            self._hedge_wins = 0
+            self._failures = 0
+            self._answered_by = Counter()
+
+    def statistics(self):
+        """ Return the counters as a JSON serializable dict
+        """
+        hedge_after = self._hedge_after()
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "attempts": self._attempts,
+                "retries": self._retries,
+                "hedged": self._hedged,
+                "hedge_rate": round(self._hedged / max(self._requests, 1), 4),
+                "hedge_wins": self._hedge_wins,
+                "failures": self._failures,
+                "answered_by": dict(self._answered_by),
+                "hedge_after_ms": None if hedge_after is None else round(hedge_after * 1000, 2),
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _hedge_after(self):
+        """ Seconds after which a request is hedged, None if it is not
+        """
+        with self._lock:
+            if not self.hedge or len(self._latencies) < self.min_hedge_samples:
+                return None
+            return float(np.percentile(self._latencies, self.hedge_percentile))
+
+    def _send(self, replica, files, headers, deadline):
+        import requests
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout("Deadline passed before the request to {}".format(self.urls[replica]))
+        headers = dict(headers, **{_TIMEOUT_HEADER: str(int(remaining * 1000))})
+        with self._lock:
+            self._attempts += 1
+        start = time.monotonic()
+        response = self._session.post(self.urls[replica], files=files, headers=headers, timeout=remaining)
+        if response.status_code not in _RETRY_STATUSES:
+            with self._lock:
+                self._latencies.append(time.monotonic() - start)
+        return response
+
+    def _attempt(self, replica, files, headers, deadline):
+        """ Response of an attempt and the replica that answered, hedged if it takes too long
+        """
+        hedge_after = self._hedge_after()
+        if hedge_after is None:
+            return self._send(replica, files, headers, deadline), replica
+        first = self._executor.submit(self._send, replica, files, headers, deadline)
+        done, _ = wait([first], timeout=min(hedge_after, max(deadline - time.monotonic(), 0)))
+        if done:
+            return first.result(), replica
+        with self._lock:
+            self._hedged += 1
+        hedge_replica = (replica + 1) % len(self.urls)
+        second = self._executor.submit(self._send, hedge_replica, files, headers, deadline)
+        replicas = {first: replica, second: hedge_replica}
+        pending = set(replicas)
+        result = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as error:
+                    result = result or error
+                    continue
+                # The first answer wins, unless it is to be retried and the other may be better
+                if response.status_code not in _RETRY_STATUSES or not pending:
+                    if future is second:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return response, replicas[future]
+                result = (response, replicas[future])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def post(self, images, headers=None):
+        """ Post images and return the requests.Response of the service
+
+        images is a dict of image names to image bytes, file objects or the
+        (bytes, content type) tuples of to_tensor. The response of the last
+        attempt is returned whatever its status. Raises the requests exception
+        of the last attempt if none was answered, e.g. requests.Timeout after
+        the deadline.
+        """
+        import requests
+
+        deadline = time.monotonic() + self.timeout
+        headers = dict(self.headers, **(headers or {}))
+        files = {}
+        for key, img in images.items():
+            if isinstance(img, tuple):
+                files[key] = (key,) + img
+            else:
+                files[key] = (key, img if isinstance(img, bytes) else img.read())
+        with self._lock:
+            self._requests += 1
+            replica = self._next
+            self._next = (self._next + 1) % len(self.urls)
+
+        for attempt in range(self.max_retries + 1):
+            response, error = None, None
+            try:
+                response, answered_by = self._attempt(replica, files, headers, deadline)
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                error = exception
+            if response is not None and response.status_code not in _RETRY_STATUSES:
+                break
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if response is not None and response.status_code == 503:
+                try:
+                    delay = max(delay, float(response.headers.get("Retry-After")))
+                except (TypeError, ValueError):
+                    pass
+            if attempt == self.max_retries or time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+            replica = (replica + 1) % len(self.urls)
+            with self._lock:
+                self._retries += 1
+
+        with self._lock:
+            if response is None:
+                self._failures += 1
+            else:
+                self._answered_by[self.urls[answered_by]] += 1
+                if response.status_code in _RETRY_STATUSES:
+                    self._failures += 1
+        if response is None:
+            raise error
+        return response
+
+
+_LOCUST_PERCENTILES = (50, 66, 75, 80, 90, 95, 98, 99, 100)
+
+
+def _write_locust_csvs(csv_prefix, name, histogram, failures, content_size, duration):
+    """ Write the summaries in the format of locust's --csv --only-summary output
+    """
+    requests = histogram.count + failures
+    row = [
+        histogram.count + failures,
+        failures,
+        int(round(histogram.percentile(50) * 1000)),
+        int(round(histogram.mean() * 1000)),
+        int(round((histogram.min if histogram.count else 0) * 1000)),
+        int(round(histogram.max * 1000)),
+        int(content_size / requests) if requests else 0,
+        round(requests / duration, 2),
+    ]
+    with open(csv_prefix + "_requests.csv", "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(
+            [
+                "Method", "Name", "# requests", "# failures", "Median response time",
+                "Average response time", "Min response time", "Max response time",
+                "Average Content Size", "Requests/s",
+            ]
+        )
+        writer.writerow(["POST", name] + row)
+        writer.writerow(["None", "Total"] + row)
+    distribution = [int(round(histogram.percentile(p) * 1000)) for p in _LOCUST_PERCENTILES]
+    with open(csv_prefix + "_distribution.csv", "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(["Name", "# requests"] + ["{}%".format(p) for p in _LOCUST_PERCENTILES])
+        writer.writerow(["POST " + name, requests] + distribution)
+        writer.writerow(["Total", requests] + distribution)
+
+
+async def _open_loop(url, images, rate, duration, arrival, headers, max_connections, timeout):
+    import asyncio
+
+    import aiohttp
+
+    loop = asyncio.get_event_loop()
+    histogram = LatencyHistogram()
+    stats = {"failures": 0, "content_size": 0}
+
+    async def send(session, img, intended_start):
+        data = aiohttp.FormData()
+        data.add_field("image", img, filename="image")
+        try:
+            async with session.post(url, data=data) as resp:
+                body = await resp.read()
+                ok = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok, body = False, b""
+        stats["content_size"] += len(body)
+        if ok:
+            # Measured from when the request should have been sent, so requests
+            # delayed by a saturated client or server are not under-reported
+            histogram.record(loop.time() - intended_start)
+        else:
+            stats["failures"] += 1
+
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    async with aiohttp.ClientSession(
+        connector=connector, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        image_iter = itertools.cycle(images)
+        tasks = []
+        start = loop.time()
+        intended_start = start
+        while intended_start - start < duration:
+            delay = intended_start - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(session, next(image_iter), intended_start)))
+            if arrival == "poisson":
+                intended_start += random.expovariate(rate)
+            else:
+                intended_start += 1.0 / rate
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - start
+    return histogram, stats["failures"], stats["content_size"], elapsed
+
+
+def run_open_loop(
+    url,
+    images,
+    rate,
+    duration,
+    arrival="constant",
+    headers=None,
+    max_connections=100,
+    timeout=60,
+    csv_prefix=None,
+):
+    """ Post images to url at a target arrival rate, independent of response times
+
+    Unlike locust's users, which wait for a response before sending the next
+    request, requests are sent at rate per second with constant or poisson
+    distributed inter-arrival times over up to max_connections keep-alive
+    connections. Latencies are recorded from the intended send time, which
+    corrects for coordinated omission. If csv_prefix is given the summaries are
+    written to <csv_prefix>_requests.csv and <csv_prefix>_distribution.csv in
+    the format locust uses.
+
+    Returns the LatencyHistogram and the number of failed requests.
+    """
+    # Only the open loop needs asyncio, which is slow to import
+    import asyncio
+
+    if arrival not in ("constant", "poisson"):
+        raise ValueError("arrival must be constant or poisson")
+    loop = asyncio.new_event_loop()
+    result = {}
+
+    def run():
+        # A new loop in its own thread also works where a loop is already
+        # running, such as in a notebook kernel
+        asyncio.set_event_loop(loop)
+        try:
+            result["value"] = loop.run_until_complete(
+                _open_loop(url, images, rate, duration, arrival, headers, max_connections, timeout)
+            )
+        except Exception as error:
+            result["error"] = error
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    histogram, failures, content_size, elapsed = result["value"]
+    if csv_prefix is not None:
+        _write_locust_csvs(
+            csv_prefix, urllib.parse.urlparse(url).path, histogram, failures, content_size, elapsed
+        )
+    return histogram, failures
+
+
+def _local_server(handler_class):
+    """ Threaded HTTP server on a free local port, serving in a daemon thread
+    """
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _fetch_benchmark(num_images, latency_ms, max_workers):
+    """ Fetch images from a local server that answers after latency_ms
+
+    New connections take another latency_ms to set up, as a TLS handshake
+    with a remote server would.
+    """
+    import shutil
+    from http.server import BaseHTTPRequestHandler
+
+    rng = np.random.RandomState(0)
+    images = [
+        to_bytes(Image.fromarray(rng.randint(0, 255, size=(224, 224, 3), dtype=np.uint8)))
+        for _ in range(num_images)
+    ]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes, which Nagle's algorithm delays
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            time.sleep(latency_ms / 1000.0)
+            BaseHTTPRequestHandler.setup(self)
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000.0)
+            body = images[int(self.path.strip("/").split(".")[0])]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _local_server(Handler)
+    urls = ["http://127.0.0.1:{}/{}.jpg".format(server.server_port, i) for i in range(num_images)]
+    disk_dir = tempfile.mkdtemp()
+    fetcher = ImageFetcher(disk_dir=disk_dir)
+
+    def timed(name, func):
+        start = time.perf_counter()
+        fetched = func()
+        elapsed = time.perf_counter() - start
+        assert fetched == images
+        print("{0:<36} {1:8.1f} ms  {2:7.2f} ms/image".format(name, elapsed * 1000, elapsed * 1000 / num_images))
+
+    try:
+        timed("urlopen per image", lambda: [urllib.request.urlopen(url).read() for url in urls])
+        timed("pooled, sequential", lambda: [fetcher.fetch(url) for url in urls])
+        fetcher.clear()
+        shutil.rmtree(disk_dir)
+        timed("pooled, {} at a time".format(max_workers), lambda: fetcher.fetch_many(urls, max_workers))
+        timed("memory cache", lambda: fetcher.fetch_many(urls, max_workers))
+        fetcher.clear()
+        timed("disk cache", lambda: fetcher.fetch_many(urls, max_workers))
+        print(fetcher.statistics())
+    finally:
+        server.shutdown()
+        shutil.rmtree(disk_dir, ignore_errors=True)
+
+
+def _client_benchmark(num_requests, concurrency, latency_ms, slow_rate, slow_ms, error_rate):
+    """ Score against two local stub replicas with injected slowness and errors
+
+    Every replica answers after latency_ms, after slow_ms instead for a share
+    slow_rate of the requests, and with a 503 for a share error_rate of them.
+    """
+    import requests
+    from http.server import BaseHTTPRequestHandler
+
+    rng = random.Random(0)
+    body = json.dumps([{"image": [["n0", "class_0", "1.0"]]}, "Computed in 0 ms"]).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            draw = rng.random()
+            if draw < error_rate:
+                time.sleep(latency_ms / 1000.0)
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            slow = draw < error_rate + slow_rate
+            time.sleep((slow_ms if slow else latency_ms) / 1000.0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    servers = [_local_server(Handler) for _ in range(2)]
+    urls = ["http://127.0.0.1:{}/score".format(server.server_port) for server in servers]
+    image = to_bytes(Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)))
+
+    def run(name, post):
+        latencies, failures = [], [0]
+
+        def client(index):
+            for _ in range(num_requests // concurrency):
+                start = time.monotonic()
+                try:
+                    ok = post(index).status_code == 200
+                except requests.RequestException:
+                    ok = False
+                latencies.append(time.monotonic() - start)
+                failures[0] += not ok
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(
+            "{0:<28} p50 {1:7.1f} ms  p95 {2:7.1f} ms  p99 {3:7.1f} ms  max {4:7.1f} ms  "
+            "failed {5:4d}".format(name, p50, p95, p99, max(latencies) * 1000, failures[0])
+        )
+
+    try:
+        run("requests.post", lambda index: requests.post(urls[index % 2], files={"image": image}))
+        with ScoringClient(urls, max_retries=0) as client:
+            run("pooled", lambda index: client.post({"image": image}))
+        with ScoringClient(urls) as client:
+            run("pooled, retries", lambda index: client.post({"image": image}))
+            print(client.statistics())
+        with ScoringClient(urls, hedge=True) as client:
+            run("pooled, retries, hedging", lambda index: client.post({"image": image}))
+            print(client.statistics())
+    finally:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the image fetching of read_image_from, or the ScoringClient with --client"
+    )
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20,
+                        help="latency of the local servers per request and per new connection")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--client", action="store_true",
+                        help="score against two local stub replicas with injected slowness instead")
+    parser.add_argument("--requests", type=int, default=400, help="requests scored by the clients")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--slow-rate", type=float, default=0.02, help="share of slow requests")
+    parser.add_argument("--slow-ms", type=float, default=500, help="latency of slow requests")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="share of 503 responses")
+    args = parser.parse_args()
+    if args.client:
+        _client_benchmark(
+            args.requests, args.concurrency, args.latency_ms, args.slow_rate, args.slow_ms, args.error_rate
+        )
+    else:
+        _fetch_benchmark(args.images, args.latency_ms, args.workers)